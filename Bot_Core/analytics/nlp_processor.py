@@ -1,38 +1,83 @@
 from keybert import KeyBERT
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
+import os
+import threading
 import numpy as np
-from collections import Counter
+from collections import Counter, OrderedDict
+
+from Bot_Core.analytics.russian_text import CandidateExtractor, keyword_matches, phrase_key
+from Bot_Core.utils.metrics import NLP_INFERENCE_SECONDS, timed
+
+# Сколько эмбеддингов фраз и ответов держать в памяти между вызовами
+# (~3 КБ на эмбеддинг 768 float32; кэш у каждого воркера свой)
+EMBEDDING_CACHE_SIZE = int(os.getenv('NLP_EMBEDDING_CACHE_SIZE', '5000'))
 
 class NLPProcessor:
     def __init__(self):
-        self.model = KeyBERT('distilbert-base-nli-mean-tokens')
+        with NLP_INFERENCE_SECONDS.time(operation='load_model'):
+            self.model = KeyBERT('distilbert-base-nli-mean-tokens')
         self.threshold = 0.3  # Порог релевантности для ключевых слов
+        # Кандидаты в ключевые фразы: русские стоп-слова, n-граммы из 1-2 слов
+        self.candidates = CandidateExtractor(ngram_range=(1, 2))
+        # Нормированные эмбеддинги: одни и те же фразы встречаются в сотнях ответов
+        self._embeddings: OrderedDict = OrderedDict()
+        self._embeddings_lock = threading.Lock()
 
+    @timed(NLP_INFERENCE_SECONDS, operation='extract_keywords')
     def extract_keywords(self, text: str, top_n: int = 5) -> List[Tuple[str, float]]:
         """Извлечение ключевых слов из текста"""
-        keywords = self.model.extract_keywords(
-            text,
-            keyphrase_ngram_range=(1, 2),
-            stop_words='russian',
-            top_n=top_n
-        )
-        return keywords
+        # То же ранжирование, что у KeyBERT по умолчанию (косинус фразы и текста), но
+        # кандидаты строятся заранее подготовленным экстрактором, а их эмбеддинги кэшируются
+        candidates = self.candidates(text)
+        if not candidates:
+            return []
+        vectors = self.embed([text] + candidates)
+        scores = vectors[1:] @ vectors[0]
+        top = np.argsort(-scores)[:top_n]
+        return [(candidates[i], round(float(scores[i]), 4)) for i in top]
+
+    @timed(NLP_INFERENCE_SECONDS, operation='embed')
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Нормированные эмбеддинги текстов; в модель уходят только отсутствующие в кэше"""
+        vectors = {}
+        with self._embeddings_lock:
+            for text in texts:
+                if text in self._embeddings:
+                    self._embeddings.move_to_end(text)
+                    vectors[text] = self._embeddings[text]
+        missing = [text for text in dict.fromkeys(texts) if text not in vectors]
+        if missing:
+            computed = np.asarray(self.model.model.embed(missing), dtype=np.float32)
+            computed /= np.clip(np.linalg.norm(computed, axis=1, keepdims=True), 1e-12, None)
+            vectors.update(zip(missing, computed))
+            with self._embeddings_lock:
+                self._embeddings.update(zip(missing, computed))
+                while len(self._embeddings) > EMBEDDING_CACHE_SIZE:
+                    self._embeddings.popitem(last=False)
+        return np.stack([vectors[text] for text in texts])
+
+    def hypothesis_features(self, hypothesis: str) -> Dict:
+        """Ключевые слова и эмбеддинг гипотезы — считаются один раз и хранятся в базе"""
+        return {
+            "keywords": [[kw, float(score)] for kw, score in self.extract_keywords(hypothesis)],
+            "embedding": [float(x) for x in self.embed([hypothesis])[0]]
+        }
 
     def analyze_response(self, response: str, hypothesis_keywords: List[str]) -> Dict:
         """Анализ ответа респондента"""
         # Извлекаем ключевые слова из ответа
         response_keywords = self.extract_keywords(response)
         
-        # Проверяем соответствие гипотезе
+        # Проверяем соответствие гипотезе с учетом словоформ («ручной ввод» ~ «ручного ввода»)
         relevance_scores = []
         for h_keyword in hypothesis_keywords:
             max_score = 0
             for r_keyword, score in response_keywords:
-                if h_keyword.lower() in r_keyword.lower():
+                if keyword_matches(h_keyword, r_keyword):
                     max_score = max(max_score, score)
             relevance_scores.append(max_score)
         
-        avg_relevance = np.mean(relevance_scores)
+        avg_relevance = float(np.mean(relevance_scores)) if relevance_scores else 0.0
         
         return {
             "keywords": [kw for kw, _ in response_keywords],
@@ -42,20 +87,21 @@ class NLPProcessor:
 
     def detect_bias(self, responses: List[str]) -> Dict:
         """Определение возможных искажений в ответах"""
-        all_keywords = []
+        keyword_freq = Counter()
+        surface_forms = {}
         for response in responses:
-            keywords = self.extract_keywords(response)
-            all_keywords.extend([kw for kw, _ in keywords])
-        
-        # Подсчет частоты ключевых слов
-        keyword_freq = Counter(all_keywords)
+            # Разные словоформы одной фразы считаются вместе, в ответе — не больше одного раза
+            keys = {phrase_key(kw): kw for kw, _ in self.extract_keywords(response)}
+            for key, keyword in keys.items():
+                surface_forms.setdefault(key, keyword)
+            keyword_freq.update(keys.keys())
         
         # Определение потенциальных искажений
         biases = []
-        for keyword, freq in keyword_freq.items():
+        for key, freq in keyword_freq.items():
             if freq / len(responses) > 0.7:  # Если слово встречается в >70% ответов
                 biases.append({
-                    "keyword": keyword,
+                    "keyword": surface_forms[key],
                     "frequency": freq / len(responses)
                 })
         
@@ -64,15 +110,20 @@ class NLPProcessor:
             "potential_biases": biases
         }
 
-    def generate_insights(self, responses: List[str], hypothesis: str) -> Dict:
+    def generate_insights(self, responses: List[str], hypothesis: str,
+                          hypothesis_keywords: Optional[List[str]] = None) -> Dict:
         """Генерация инсайтов на основе ответов"""
-        hypothesis_keywords = [kw for kw, _ in self.extract_keywords(hypothesis)]
-        
+        if hypothesis_keywords is None:
+            hypothesis_keywords = [kw for kw, _ in self.extract_keywords(hypothesis)]
+        analyses = [self.analyze_response(response, hypothesis_keywords) for response in responses]
+        return self._summarize(responses, analyses, hypothesis_keywords)
+
+    @staticmethod
+    def _summarize(responses: List[str], analyses: List[Dict], hypothesis_keywords: List[str]) -> Dict:
         relevant_responses = 0
         key_insights = []
         
-        for response in responses:
-            analysis = self.analyze_response(response, hypothesis_keywords)
+        for response, analysis in zip(responses, analyses):
             if analysis["is_relevant"]:
                 relevant_responses += 1
                 if analysis["relevance_score"] > 0.5:  # Высоко релевантные ответы
@@ -84,6 +135,61 @@ class NLPProcessor:
             "hypothesis_keywords": hypothesis_keywords
         }
 
+    def compare_interviews(self, interviews: Dict[int, List[str]], hypothesis: str,
+                           hypothesis_keywords: Optional[List[str]] = None,
+                           hypothesis_embedding: Optional[List[float]] = None) -> Dict:
+        """Сравнение интервью по одной гипотезе: общие инсайты и показатели каждого интервью"""
+        if hypothesis_keywords is None:
+            hypothesis_keywords = [kw for kw, _ in self.extract_keywords(hypothesis)]
+        # Каждый ответ анализируется один раз — и для общего итога, и для своего интервью
+        analyses = {
+            interview_id: [self.analyze_response(r, hypothesis_keywords) for r in responses]
+            for interview_id, responses in interviews.items()
+        }
+        all_responses = [r for responses in interviews.values() for r in responses]
+        summary = self._summarize(
+            all_responses, [a for items in analyses.values() for a in items], hypothesis_keywords
+        )
+
+        similarities = {}
+        if hypothesis_embedding is not None:
+            # Смысловая близость ответов к гипотезе: косинус, усредненный по интервью
+            target = np.asarray(hypothesis_embedding, dtype=np.float32)
+            target = target / (np.linalg.norm(target) or 1.0)
+            # Эмбеддинги ответов уже в кэше после извлечения ключевых слов
+            scores = self.embed(all_responses) @ target
+            offset = 0
+            for interview_id, responses in interviews.items():
+                similarities[interview_id] = float(np.mean(scores[offset:offset + len(responses)]))
+                offset += len(responses)
+
+        summary["interviews"] = [
+            {
+                "interview_id": interview_id,
+                "responses": len(responses),
+                "confirmation_rate": self._summarize(
+                    responses, analyses[interview_id], hypothesis_keywords
+                )["confirmation_rate"],
+                "similarity": similarities.get(interview_id)
+            }
+            for interview_id, responses in interviews.items()
+        ]
+        if similarities:
+            summary["similarity"] = float(np.mean(list(similarities.values())))
+        return summary
+
+
+def ensure_hypothesis_features(db, processor: NLPProcessor, hypothesis_id: int) -> Tuple[Optional[List[str]], Optional[List[float]]]:
+    """Ключевые слова и эмбеддинг гипотезы из базы; если фоновая задача еще не успела — считаем сейчас"""
+    hypothesis = db.get_hypothesis(hypothesis_id)
+    if hypothesis is None:
+        return None, None
+    if hypothesis.status != 'ready':
+        features = processor.hypothesis_features(hypothesis.text)
+        db.update_hypothesis_features(hypothesis_id, **features)
+        return [kw for kw, _ in features["keywords"]], features["embedding"]
+    return [kw for kw, _ in hypothesis.keywords], hypothesis.embedding
+
 if __name__ == "__main__":
     # Пример использования
     processor = NLPProcessor()
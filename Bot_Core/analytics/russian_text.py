@@ -0,0 +1,205 @@
+"""Подготовка русского текста для извлечения ключевых фраз.
+
+Стоп-слова поставляются вместе с кодом, нормальная форма слова берется из pymorphy
+(если установлен) или из встроенного стеммера Snowball. Результаты разбора слов
+кэшируются: в транскриптах одни и те же слова повторяются тысячи раз.
+"""
+import logging
+import re
+from functools import lru_cache
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Служебные слова и слова-паразиты, типичные для устной речи респондентов
+STOP_WORDS = frozenset(word.replace('ё', 'е') for word in """
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только
+ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть
+был него до вас нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть
+надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто
+этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее сейчас были
+куда зачем всех никогда можно при наконец два об другой хоть после над больше тот через эти
+нас про всего них какая много разве три эту моя впрочем хорошо свою этой перед иногда лучше
+чуть том нельзя такой им более всегда конечно всю между это эта эти свой своя свои своих
+наш наша наши ваш ваша ваши который которая которые которых которым весь вся всё всем
+очень просто вообще типа короче значит знаете понимаете скажем например наверное кажется
+вроде честно говоря допустим ладно ага угу ой да-да нет-нет кстати собственно то есть
+также либо пока ещё сам сама сами само какие какой-то что-то кто-то где-то как-то
+""".split())
+
+_WORD_RE = re.compile(r"[а-яёa-z0-9]+(?:-[а-яёa-z0-9]+)*")
+# Ключевые фразы не переходят через знаки препинания
+_CLAUSE_RE = re.compile(r"[.,;:!?()\[\]«»\"…—–\n]+")
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace('ё', 'е')
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_RE.findall(normalize(text))
+
+
+@lru_cache(maxsize=1)
+def get_morph_analyzer():
+    """Морфологический анализатор pymorphy, если установлен; иначе None и используется стеммер"""
+    for module in ('pymorphy3', 'pymorphy2'):
+        try:
+            return __import__(module).MorphAnalyzer()
+        except Exception:
+            continue
+    logger.info("pymorphy недоступен, слова нормализуются стеммером Snowball")
+    return None
+
+
+# --- Стеммер Snowball для русского языка -----------------------------------------
+
+_VOWELS = set('аеиоуыэюя')
+
+_PERFECTIVE_GERUND = (('в', 'вши', 'вшись'), ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'))
+_ADJECTIVE = ((), (
+    'ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'его', 'ого',
+    'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'
+))
+_PARTICIPLE = (('ем', 'нн', 'вш', 'ющ', 'щ'), ('ивш', 'ывш', 'ующ'))
+_REFLEXIVE = ((), ('ся', 'сь'))
+_VERB = (
+    ('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно'),
+    ('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен',
+     'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю')
+)
+_NOUN = ((), (
+    'а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой', 'ий', 'й',
+    'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия',
+    'ья', 'я'
+))
+
+
+def _strip(word: str, start: int, groups) -> Tuple[str, bool]:
+    """Удаляет самое длинное окончание из groups в области word[start:].
+
+    Окончания первой группы удаляются, только если перед ними стоит «а» или «я».
+    """
+    region = word[start:]
+    best, first_group = '', False
+    for is_first, endings in zip((True, False), groups):
+        for ending in endings:
+            if len(ending) > len(best) and region.endswith(ending):
+                best, first_group = ending, is_first
+    if not best:
+        return word, False
+    if first_group and (len(region) == len(best) or region[-len(best) - 1] not in 'ая'):
+        return word, False
+    return word[:-len(best)], True
+
+
+def _regions(word: str) -> Tuple[int, int]:
+    """Начало RV (после первой гласной) и R2 по правилам Snowball"""
+    rv = r1 = r2 = len(word)
+    for i, char in enumerate(word):
+        if char in _VOWELS:
+            rv = i + 1
+            break
+    for i in range(1, len(word)):
+        if word[i - 1] in _VOWELS and word[i] not in _VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i - 1] in _VOWELS and word[i] not in _VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+
+def snowball_stem(word: str) -> str:
+    word = normalize(word)
+    rv, r2 = _regions(word)
+    if rv >= len(word):
+        return word
+
+    # Шаг 1: деепричастие, иначе возвратность + прилагательное/причастие, глагол или существительное
+    word, found = _strip(word, rv, _PERFECTIVE_GERUND)
+    if not found:
+        word, _ = _strip(word, rv, _REFLEXIVE)
+        word, found = _strip(word, rv, _ADJECTIVE)
+        if found:
+            word, _ = _strip(word, rv, _PARTICIPLE)
+        else:
+            word, found = _strip(word, rv, _VERB)
+            if not found:
+                word, _ = _strip(word, rv, _NOUN)
+
+    # Шаг 2
+    if word[rv:].endswith('и'):
+        word = word[:-1]
+    # Шаг 3: словообразовательные окончания в R2
+    for ending in ('ость', 'ост'):
+        if word.endswith(ending) and len(word) - len(ending) >= r2:
+            word = word[:-len(ending)]
+            break
+    # Шаг 4: превосходная степень, двойное «н», мягкий знак
+    for ending in ('ейше', 'ейш'):
+        if word[rv:].endswith(ending):
+            word = word[:-len(ending)]
+            break
+    if word[rv:].endswith('нн'):
+        word = word[:-1]
+    elif word[rv:].endswith('ь'):
+        word = word[:-1]
+    return word
+
+
+@lru_cache(maxsize=100000)
+def lemma(word: str) -> str:
+    """Нормальная форма слова (лемма pymorphy или основа Snowball)"""
+    word = normalize(word)
+    morph = get_morph_analyzer()
+    if morph is not None:
+        return morph.parse(word)[0].normal_form.replace('ё', 'е')
+    return snowball_stem(word)
+
+
+@lru_cache(maxsize=100000)
+def phrase_key(phrase: str) -> Tuple[str, ...]:
+    """Фраза без учета словоформ: «ручного ввода» и «ручной ввод» дают один ключ"""
+    return tuple(lemma(token) for token in tokenize(phrase))
+
+
+class CandidateExtractor:
+    """Кандидаты в ключевые фразы: n-граммы подряд идущих значимых слов внутри одной клаузы.
+
+    Создается один раз и переиспользуется; заменяет CountVectorizer, который KeyBERT
+    строил заново при каждом вызове (и без русского списка стоп-слов).
+    """
+
+    def __init__(self, ngram_range: Tuple[int, int] = (1, 2), stop_words=STOP_WORDS, min_length: int = 2):
+        self.ngram_range = ngram_range
+        self.stop_words = stop_words
+        self.min_length = min_length
+        # Кэш свой у каждого экземпляра: lru_cache на методе держал бы все экстракторы в памяти
+        self.is_content_word = lru_cache(maxsize=100000)(self._is_content_word)
+
+    def _is_content_word(self, token: str) -> bool:
+        return len(token) >= self.min_length and not token.isdigit() and token not in self.stop_words
+
+    def __call__(self, text: str) -> List[str]:
+        low, high = self.ngram_range
+        candidates = {}
+        for clause in _CLAUSE_RE.split(normalize(text)):
+            run = []
+            for token in _WORD_RE.findall(clause) + ['']:
+                if token and self.is_content_word(token):
+                    run.append(token)
+                    continue
+                # Стоп-слово или конец клаузы завершают последовательность значимых слов
+                for n in range(low, high + 1):
+                    for i in range(len(run) - n + 1):
+                        candidates.setdefault(' '.join(run[i:i + n]))
+                run = []
+        return list(candidates)
+
+
+def keyword_matches(hypothesis_keyword: str, response_keyword: str) -> bool:
+    """Все слова ключевой фразы гипотезы встречаются (в любой форме) во фразе ответа"""
+    expected = phrase_key(hypothesis_keyword)
+    return bool(expected) and set(expected) <= set(phrase_key(response_keyword))
@@ -0,0 +1,218 @@
+"""Шардированный режим: диспетчер получает апдейты и раздает их N процессам-воркерам.
+
+Апдейты одного пользователя всегда попадают в один и тот же воркер
+(user_id % N), поэтому порядок сообщений пользователя сохраняется.
+user_data и состояния диалога хранятся в sessions.db (SQLitePersistence),
+так что перезапуск воркера не прерывает интервью.
+
+    python -m Bot_Core.cluster --workers 4
+
+SIGHUP — поочередный перезапуск воркеров, SIGINT/SIGTERM — остановка.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+from dotenv import load_dotenv
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logger = logging.getLogger(__name__)
+
+STOP = None  # Сигнал воркеру: дообработать очередь и завершиться
+
+UPDATE_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request', 'channel_post', 'edited_channel_post',
+)
+
+
+def shard_for(update: dict, workers: int) -> int:
+    """Номер воркера для апдейта: по id пользователя, иначе по id чата"""
+    for field in UPDATE_FIELDS:
+        payload = update.get(field)
+        if not payload:
+            continue
+        user = payload.get('from') or payload.get('user')
+        if user:
+            return int(user['id']) % workers
+        chat = payload.get('chat')
+        if chat:
+            return int(chat['id']) % workers
+    return 0
+
+
+def configure_worker_env(index: int, workers: int):
+    """Отдельный файл лога и порт метрик для каждого воркера, доля общего лимита Bot API"""
+    base, ext = os.path.splitext(os.getenv('LOG_FILE', os.path.join('logs', 'bot.log')))
+    os.environ['LOG_FILE'] = f"{base}.worker{index}{ext}"
+    port = os.getenv('METRICS_PORT', '9108')
+    if port:
+        os.environ['METRICS_PORT'] = str(int(port) + index)
+    # Лимит Telegram действует на бота целиком, а FloodControlLimiter у каждого воркера свой.
+    # Лимиты на чат не делятся: чат всегда обслуживает один воркер
+    os.environ['TG_GLOBAL_RATE'] = str(float(os.getenv('TG_GLOBAL_RATE', '30')) / workers)
+
+
+def worker_main(index: int, workers: int, updates_queue):
+    """Точка входа процесса-воркера"""
+    # Ctrl+C обрабатывает диспетчер и останавливает воркеры по очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_worker_env(index, workers)
+    asyncio.run(_run_worker(index, updates_queue))
+
+
+async def _run_worker(index: int, updates_queue):
+    from telegram import Update
+    from Bot_Core import main as bot_main
+    from Bot_Core.data.persistence import SQLitePersistence
+
+    application = bot_main.build_application(
+        os.getenv('TELEGRAM_BOT_TOKEN'), persistence=SQLitePersistence(bot_main.db)
+    )
+    loop = asyncio.get_running_loop()
+    async with application:
+        await bot_main.on_startup(application)
+        await application.start()
+        logger.info(f"Воркер {index} запущен (pid {os.getpid()})")
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates_queue.get)
+                if data is STOP:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            # stop() дообрабатывает очередь приложения и сохраняет состояние в БД
+            await application.stop()
+            await bot_main.on_stop(application)
+    logger.info(f"Воркер {index} остановлен")
+
+
+class Dispatcher:
+    def __init__(self, token: str, workers: int, join_timeout: float = 60):
+        self.token = token
+        self.workers = workers
+        self.join_timeout = join_timeout
+        self._ctx = multiprocessing.get_context('spawn')
+        self.queues = [self._ctx.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self._stopping = asyncio.Event()
+        self._restarting = set()
+
+    def spawn(self, index: int):
+        process = self._ctx.Process(
+            target=worker_main, args=(index, self.workers, self.queues[index]), name=f'bot-worker-{index}'
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Запущен воркер {index} (pid {process.pid})")
+
+    async def stop_worker(self, index: int):
+        process = self.processes[index]
+        if process is None or not process.is_alive():
+            return
+        self.queues[index].put(STOP)
+        await asyncio.get_running_loop().run_in_executor(None, process.join, self.join_timeout)
+        if process.is_alive():
+            logger.warning(f"Воркер {index} не завершился за {self.join_timeout} с, принудительная остановка")
+            process.terminate()
+            process.join()
+
+    async def restart_worker(self, index: int):
+        """Мягкий перезапуск: новые апдейты копятся в очереди, пока поднимается новый процесс"""
+        self._restarting.add(index)
+        try:
+            await self.stop_worker(index)
+            self.spawn(index)
+        finally:
+            self._restarting.discard(index)
+
+    async def rolling_restart(self):
+        logger.info("Поочередный перезапуск воркеров")
+        for index in range(self.workers):
+            await self.restart_worker(index)
+
+    async def supervise(self):
+        """Перезапуск упавших воркеров"""
+        while not self._stopping.is_set():
+            for index, process in enumerate(self.processes):
+                if index not in self._restarting and process is not None and not process.is_alive():
+                    logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапуск")
+                    self.spawn(index)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def poll(self):
+        """Long polling Bot API и маршрутизация апдейтов по воркерам"""
+        from telegram import Bot, Update
+        from telegram.error import NetworkError, TimedOut
+        from telegram.request import HTTPXRequest
+
+        bot = Bot(self.token, get_updates_request=HTTPXRequest(connect_timeout=30, read_timeout=30))
+        async with bot:
+            await bot.delete_webhook()
+            offset = None
+            try:
+                while not self._stopping.is_set():
+                    try:
+                        updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+                    except (TimedOut, NetworkError) as e:
+                        logger.warning(f"Ошибка получения апдейтов: {e}, повтор через 5 секунд")
+                        await asyncio.sleep(5)
+                        continue
+                    for update in updates:
+                        data = update.to_dict()
+                        self.queues[shard_for(data, self.workers)].put(data)
+                        offset = update.update_id + 1
+            finally:
+                if offset is not None:
+                    # Подтверждаем последнюю пачку, иначе после рестарта она придет повторно
+                    try:
+                        await bot.get_updates(offset=offset, timeout=0)
+                    except Exception as e:
+                        logger.warning(f"Не удалось подтвердить апдейты: {e}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.rolling_restart()))
+
+        for index in range(self.workers):
+            self.spawn(index)
+        supervisor = asyncio.create_task(self.supervise())
+        poller = asyncio.create_task(self.poll())
+        await self._stopping.wait()
+
+        logger.info("Остановка диспетчера...")
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+        await supervisor
+        await asyncio.gather(*(self.stop_worker(index) for index in range(self.workers)))
+        logger.info("Все воркеры остановлены")
+
+
+def run_cluster(workers: int):
+    load_dotenv()
+    from Bot_Core.utils.logging_setup import setup_logging
+    setup_logging()
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        logger.error("Токен бота не найден в переменных окружения!")
+        sys.exit(1)
+    logger.info(f"Запуск диспетчера с {workers} воркерами")
+    asyncio.run(Dispatcher(token, workers).run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Custos AI Bot в шардированном режиме")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BOT_WORKERS', os.cpu_count() or 2)),
+                        help="Количество процессов-воркеров")
+    run_cluster(parser.parse_args().workers)
@@ -0,0 +1,360 @@
+"""Хранение старых интервью вне sessions.db.
+
+Интервью без новых ответов дольше RETENTION_DAYS (вместе со снимком респондента) переносятся в
+сжатые сегменты JSONL (archive/<дата>-<pid>-<n>.jsonl.gz). Сегменты только создаются
+и никогда не изменяются; таблица archive_index в базе указывает, где лежит
+каждая запись, поэтому архив остается доступным для поиска и экспорта.
+После переноса база постепенно сжимается через PRAGMA incremental_vacuum; базу,
+созданную до включения auto_vacuum, нужно один раз перевести командой enable-auto-vacuum
+(полный VACUUM — на время его выполнения бот лучше остановить).
+
+    python -m Bot_Core.data.archive enable-auto-vacuum
+    python -m Bot_Core.data.archive run
+    python -m Bot_Core.data.archive search --profession бухгалтер
+    python -m Bot_Core.data.archive export interviews.jsonl --since 2024-01-01
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import exists, func
+from sqlalchemy.orm import sessionmaker
+
+from Bot_Core.data.database import ArchiveEntry, BackgroundJob, Interview, Respondent
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMAT_VERSION = 1
+
+
+def _serialize(row, columns) -> dict:
+    record = {}
+    for column in columns:
+        value = getattr(row, column)
+        record[column] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+RESPONDENT_COLUMNS = ('id', 'name', 'age', 'profession', 'trait', 'profile', 'created_at')
+INTERVIEW_COLUMNS = ('id', 'respondent_id', 'hypothesis', 'hypothesis_id', 'responses', 'analysis',
+                     'created_at', 'updated_at')
+
+
+class InterviewArchiver:
+    """Перенос старых интервью в архив, поиск по архиву и сжатие базы"""
+
+    def __init__(self, engine, archive_dir: str = 'archive', retention_days: int = 0,
+                 batch_size: int = 500, vacuum_step_pages: int = 1000):
+        self.engine = engine
+        self.Session = sessionmaker(bind=engine, expire_on_commit=False)
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.vacuum_step_pages = vacuum_step_pages
+
+    @classmethod
+    def from_env(cls, engine) -> 'InterviewArchiver':
+        return cls(
+            engine,
+            archive_dir=os.getenv('ARCHIVE_DIR', 'archive'),
+            retention_days=int(os.getenv('RETENTION_DAYS', '0') or 0),
+            batch_size=int(os.getenv('ARCHIVE_BATCH_SIZE', '500')),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.retention_days > 0
+
+    def cutoff(self, now: datetime = None) -> datetime:
+        return (now or datetime.utcnow()) - timedelta(days=self.retention_days)
+
+    # --- Перенос в архив ---
+
+    def run(self, now: datetime = None) -> Dict[str, int]:
+        """Полный проход: интервью, осиротевшие респонденты, старые задачи, сжатие базы"""
+        if not self.enabled:
+            logger.info("Архивация отключена (RETENTION_DAYS=0)")
+            return {}
+        cutoff = self.cutoff(now)
+        stats = {'interviews': 0, 'respondents': 0, 'segments': 0, 'jobs': 0, 'freed_pages': 0}
+        while True:
+            archived = self._archive_interviews(cutoff)
+            if not archived:
+                break
+            stats['interviews'] += archived
+            stats['segments'] += 1
+        while True:
+            archived = self._archive_respondents(cutoff)
+            if not archived:
+                break
+            stats['respondents'] += archived
+            stats['segments'] += 1
+        stats['jobs'] = self._purge_jobs(cutoff)
+        stats['freed_pages'] = self.compact()
+        logger.info(f"Архивация до {cutoff:%Y-%m-%d} завершена: {stats}")
+        return stats
+
+    def _archive_interviews(self, cutoff: datetime) -> int:
+        """Интервью без новых ответов дольше срока хранения (а не просто давно созданные)"""
+        with self.Session() as session:
+            interviews = (
+                session.query(Interview)
+                .filter(
+                    Interview.created_at < cutoff,
+                    func.coalesce(Interview.updated_at, Interview.created_at) < cutoff,
+                )
+                .order_by(Interview.id)
+                .limit(self.batch_size)
+                .all()
+            )
+            if not interviews:
+                return 0
+            respondent_ids = {i.respondent_id for i in interviews}
+            respondents = {
+                r.id: r for r in session.query(Respondent).filter(Respondent.id.in_(respondent_ids))
+            }
+            records, entries = [], []
+            for interview in interviews:
+                respondent = respondents.get(interview.respondent_id)
+                record = _serialize(interview, INTERVIEW_COLUMNS)
+                record['type'] = 'interview'
+                record['respondent'] = _serialize(respondent, RESPONDENT_COLUMNS) if respondent else None
+                records.append(record)
+                entries.append(dict(
+                    record_type='interview',
+                    record_id=interview.id,
+                    respondent_id=interview.respondent_id,
+                    profession=respondent.profession if respondent else None,
+                    trait=respondent.trait if respondent else None,
+                    hypothesis=interview.hypothesis,
+                    created_at=interview.created_at,
+                ))
+            segment = self._write_segment(records)
+            self._index(session, entries, segment)
+            for interview in interviews:
+                session.delete(interview)
+            session.commit()
+            return len(interviews)
+
+    def _archive_respondents(self, cutoff: datetime) -> int:
+        """Старые респонденты, у которых в базе не осталось интервью"""
+        with self.Session() as session:
+            respondents = (
+                session.query(Respondent)
+                .filter(
+                    Respondent.created_at < cutoff,
+                    ~exists().where(Interview.respondent_id == Respondent.id),
+                )
+                .order_by(Respondent.id)
+                .limit(self.batch_size)
+                .all()
+            )
+            if not respondents:
+                return 0
+            records = [{**_serialize(r, RESPONDENT_COLUMNS), 'type': 'respondent'} for r in respondents]
+            segment = self._write_segment(records)
+            self._index(session, [
+                dict(record_type='respondent', record_id=r.id, respondent_id=r.id,
+                     profession=r.profession, trait=r.trait, created_at=r.created_at)
+                for r in respondents
+            ], segment)
+            for respondent in respondents:
+                session.delete(respondent)
+            session.commit()
+            return len(respondents)
+
+    def _purge_jobs(self, cutoff: datetime) -> int:
+        """Завершенные фоновые задачи не архивируются, а удаляются"""
+        with self.Session() as session:
+            deleted = session.query(BackgroundJob).filter(
+                BackgroundJob.status.in_(('done', 'failed')),
+                BackgroundJob.updated_at < cutoff,
+            ).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+
+    def _write_segment(self, records: List[dict]) -> str:
+        """Запись нового сегмента: сначала во временный файл, затем атомарное переименование"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        index = 0
+        while True:
+            name = f"{stamp}-{os.getpid()}-{index}.jsonl.gz"
+            if not os.path.exists(os.path.join(self.archive_dir, name)):
+                break
+            index += 1
+        path = os.path.join(self.archive_dir, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as stream:
+                header = {'type': 'header', 'format': ARCHIVE_FORMAT_VERSION, 'created_at': stamp}
+                stream.write((json.dumps(header) + '\n').encode('utf-8'))
+                for record in records:
+                    stream.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+        logger.info(f"Записан сегмент архива {name}: {len(records)} записей")
+        return name
+
+    @staticmethod
+    def _index(session, entries: List[dict], segment: str):
+        now = datetime.utcnow()
+        for entry in entries:
+            # Повторная архивация после сбоя указывает на более новый сегмент
+            existing = session.query(ArchiveEntry).filter_by(
+                record_type=entry['record_type'], record_id=entry['record_id']
+            ).first()
+            if existing:
+                for key, value in entry.items():
+                    setattr(existing, key, value)
+                existing.segment = segment
+                existing.archived_at = now
+            else:
+                session.add(ArchiveEntry(**entry, segment=segment, archived_at=now))
+
+    # --- Сжатие базы ---
+
+    def compact(self) -> int:
+        """Возврат освободившихся страниц файлу базы небольшими шагами; возвращает число страниц"""
+        raw = self.engine.raw_connection()
+        connection = raw.driver_connection
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Полный VACUUM блокирует базу надолго — только явной командой enable-auto-vacuum
+                logger.warning("База создана без auto_vacuum: место освободится после "
+                               "python -m Bot_Core.data.archive enable-auto-vacuum")
+                return 0
+            free_before = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            # Шагами, чтобы не держать блокировку записи надолго
+            while connection.execute("PRAGMA freelist_count").fetchone()[0]:
+                connection.execute(f"PRAGMA incremental_vacuum({self.vacuum_step_pages})").fetchall()
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            freed = free_before - connection.execute("PRAGMA freelist_count").fetchone()[0]
+            return max(freed, 0)
+        finally:
+            connection.isolation_level = isolation_level
+            raw.close()
+
+    def enable_auto_vacuum(self) -> bool:
+        """Однократный перевод существующей базы в auto_vacuum=INCREMENTAL (полный VACUUM)"""
+        raw = self.engine.raw_connection()
+        connection = raw.driver_connection
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            if connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return False
+            logger.warning("Перевод базы в режим auto_vacuum=INCREMENTAL (полный VACUUM)")
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            return True
+        finally:
+            connection.isolation_level = isolation_level
+            raw.close()
+
+    # --- Поиск и экспорт ---
+
+    def search(self, record_type: str = 'interview', respondent_id: int = None, profession: str = None,
+               trait: str = None, hypothesis: str = None, since: datetime = None, until: datetime = None,
+               limit: Optional[int] = 100) -> List[dict]:
+        """Поиск по индексу архива (без распаковки сегментов)"""
+        with self.Session() as session:
+            query = session.query(ArchiveEntry).filter(ArchiveEntry.record_type == record_type)
+            if respondent_id is not None:
+                query = query.filter(ArchiveEntry.respondent_id == respondent_id)
+            if profession:
+                query = query.filter(ArchiveEntry.profession == profession)
+            if trait:
+                query = query.filter(ArchiveEntry.trait == trait)
+            if hypothesis:
+                query = query.filter(ArchiveEntry.hypothesis.contains(hypothesis))
+            if since:
+                query = query.filter(ArchiveEntry.created_at >= since)
+            if until:
+                query = query.filter(ArchiveEntry.created_at < until)
+            query = query.order_by(ArchiveEntry.created_at, ArchiveEntry.record_id)
+            if limit:
+                query = query.limit(limit)
+            return [
+                {
+                    'record_type': e.record_type,
+                    'record_id': e.record_id,
+                    'respondent_id': e.respondent_id,
+                    'profession': e.profession,
+                    'trait': e.trait,
+                    'hypothesis': e.hypothesis,
+                    'created_at': e.created_at.isoformat() if e.created_at else None,
+                    'segment': e.segment,
+                }
+                for e in query
+            ]
+
+    def load(self, entries: List[dict]) -> Iterator[dict]:
+        """Полные записи для найденных элементов индекса; каждый сегмент читается один раз"""
+        wanted = defaultdict(set)
+        for entry in entries:
+            wanted[entry['segment']].add((entry['record_type'], entry['record_id']))
+        for segment, keys in wanted.items():
+            with gzip.open(os.path.join(self.archive_dir, segment), 'rt', encoding='utf-8') as stream:
+                for line in stream:
+                    record = json.loads(line)
+                    if (record.get('type'), record.get('id')) in keys:
+                        yield record
+
+    def export(self, path: str, **filters) -> int:
+        """Выгрузка найденных записей архива в JSONL"""
+        filters.setdefault('limit', None)
+        count = 0
+        with open(path, 'w', encoding='utf-8') as out:
+            for record in self.load(self.search(**filters)):
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += 1
+        return count
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from Bot_Core.data.database import DatabaseManager
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Архив старых интервью sessions.db")
+    parser.add_argument('--db', default='sessions.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('run', help="Перенести старые интервью в архив и сжать базу")
+    commands.add_parser('enable-auto-vacuum', help="Однократно включить auto_vacuum для существующей базы")
+    for name in ('search', 'export'):
+        command = commands.add_parser(name)
+        if name == 'export':
+            command.add_argument('path')
+        command.add_argument('--type', default='interview', choices=('interview', 'respondent'))
+        command.add_argument('--respondent', type=int)
+        command.add_argument('--profession')
+        command.add_argument('--trait')
+        command.add_argument('--hypothesis')
+        command.add_argument('--since', type=datetime.fromisoformat)
+        command.add_argument('--until', type=datetime.fromisoformat)
+    args = parser.parse_args()
+
+    archiver = InterviewArchiver.from_env(DatabaseManager(args.db).engine)
+    if args.command == 'run':
+        print(archiver.run())
+    elif args.command == 'enable-auto-vacuum':
+        print("Режим auto_vacuum включен" if archiver.enable_auto_vacuum() else "Режим auto_vacuum уже включен")
+    else:
+        filters = dict(record_type=args.type, respondent_id=args.respondent, profession=args.profession,
+                       trait=args.trait, hypothesis=args.hypothesis, since=args.since, until=args.until)
+        if args.command == 'search':
+            for entry in archiver.search(**filters):
+                print(json.dumps(entry, ensure_ascii=False))
+        else:
+            print(f"Выгружено записей: {archiver.export(args.path, **filters)}")
@@ -1,43 +1,175 @@
-from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, func, Column, Integer, String, JSON, DateTime, Float, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 from datetime import datetime
 import json
+import logging
+
+from Bot_Core.data.migrations import migrate
+from Bot_Core.utils.metrics import DB_OPERATION_SECONDS, timed
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
 class Respondent(Base):
     __tablename__ = 'respondents'
+    # id архивированных записей не выдаются повторно
+    __table_args__ = {'sqlite_autoincrement': True}
     
     id = Column(Integer, primary_key=True)
     name = Column(String)
     age = Column(Integer)
-    profession = Column(String)
-    trait = Column(String)
+    profession = Column(String, index=True)
+    trait = Column(String, index=True)
     profile = Column(JSON)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     
     interviews = relationship("Interview", back_populates="respondent")
 
+class Hypothesis(Base):
+    """Гипотеза исследования; ключевые слова и эмбеддинг считаются один раз фоновой задачей"""
+    __tablename__ = 'hypotheses'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, index=True)
+    text = Column(String, nullable=False)
+    keywords = Column(JSON)    # [[ключевая фраза, вес], ...]
+    embedding = Column(JSON)   # Вектор текста гипотезы
+    status = Column(String, default='pending')  # pending | ready | failed
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    interviews = relationship("Interview", back_populates="hypothesis_record")
+
 class Interview(Base):
     __tablename__ = 'interviews'
+    __table_args__ = {'sqlite_autoincrement': True}
     
     id = Column(Integer, primary_key=True)
-    respondent_id = Column(Integer, ForeignKey('respondents.id'))
-    hypothesis = Column(String)
+    respondent_id = Column(Integer, ForeignKey('respondents.id'), index=True)
+    hypothesis = Column(String)  # Текст гипотезы (сохраняется и для интервью без записи в hypotheses)
+    hypothesis_id = Column(Integer, ForeignKey('hypotheses.id'), index=True)
     responses = Column(JSON)  # Список ответов в формате JSON
     analysis = Column(JSON)   # Результаты анализа
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    # Последний ответ или анализ: по нему считается срок хранения (archive.py)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     respondent = relationship("Respondent", back_populates="interviews")
+    hypothesis_record = relationship("Hypothesis", back_populates="interviews")
+
+class TokenUsage(Base):
+    __tablename__ = 'token_usage'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, index=True)
+    respondent_id = Column(Integer, ForeignKey('respondents.id'))
+    interview_id = Column(Integer, ForeignKey('interviews.id'), index=True)
+    model = Column(String)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    estimated_prompt_tokens = Column(Integer, default=0)  # Локальная оценка до запроса
+    cost = Column(Float, default=0.0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class BotState(Base):
+    """Состояние бота (user_data, диалоги), общее для всех процессов-воркеров"""
+    __tablename__ = 'bot_state'
+    __table_args__ = (UniqueConstraint('namespace', 'key'),)
+    
+    id = Column(Integer, primary_key=True)
+    namespace = Column(String, nullable=False)  # user_data | conversation:<name>
+    key = Column(String, nullable=False)
+    data = Column(JSON)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class BackgroundJob(Base):
+    """Фоновая задача (генерация панели, анализ, экспорт), переживает перезапуск бота"""
+    __tablename__ = 'background_jobs'
+    __table_args__ = (Index('ix_background_jobs_claim', 'job_class', 'status', 'priority', 'id'),)
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    job_class = Column(String, nullable=False)  # interactive | generation | analytics
+    priority = Column(Integer, default=0)        # Меньше — важнее
+    payload = Column(JSON)
+    dedup_key = Column(String, index=True)
+    status = Column(String, default='pending', index=True)  # pending | running | done | failed
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    progress = Column(Float, default=0.0)
+    progress_message = Column(String)
+    result = Column(JSON)
+    error = Column(String)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    lease_until = Column(DateTime)
+    worker = Column(String)                      # Кто выполняет задачу (pid процесса)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ArchiveEntry(Base):
+    """Запись индекса архива: в каком сегменте лежит перенесенное из базы интервью или респондент"""
+    __tablename__ = 'archive_index'
+    __table_args__ = (UniqueConstraint('record_type', 'record_id'),)
+    
+    id = Column(Integer, primary_key=True)
+    record_type = Column(String, nullable=False)  # interview | respondent
+    record_id = Column(Integer, nullable=False)
+    respondent_id = Column(Integer, index=True)
+    profession = Column(String, index=True)
+    trait = Column(String)
+    hypothesis = Column(String)
+    created_at = Column(DateTime, index=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    segment = Column(String, nullable=False)     # Имя файла в ARCHIVE_DIR
+
+# Индексы и таблицы объявлены в моделях для наглядности, но создаются миграциями (migrations.py)
+
+# Выставляются на каждое новое соединение
+SQLITE_PRAGMAS = {
+    # Действует для новой базы (должен идти до WAL); существующую переводит archive.py enable-auto-vacuum
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',      # читатели не блокируют писателя (воркеры кластера, фоновые задачи)
+    'synchronous': 'NORMAL',    # в режиме WAL безопасно и заметно быстрее FULL
+    'busy_timeout': 30000,      # ожидание блокировки другим процессом, мс
+    'cache_size': -20000,       # ~20 МБ кэша страниц
+    'temp_store': 'MEMORY',
+    'mmap_size': 268435456,     # 256 МБ
+}
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+def optimize_on_close(dbapi_connection, connection_record):
+    """PRAGMA optimize перед закрытием соединения, как рекомендует документация SQLite"""
+    try:
+        dbapi_connection.execute("PRAGMA optimize")
+    except Exception as e:
+        logger.debug(f"PRAGMA optimize при закрытии соединения не выполнен: {e}")
 
 class DatabaseManager:
     def __init__(self, db_path="sessions.db"):
-        self.engine = create_engine(f'sqlite:///{db_path}')
-        Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        # timeout: несколько процессов-воркеров пишут в один файл
+        self.engine = create_engine(f'sqlite:///{db_path}', connect_args={'timeout': 30})
+        event.listen(self.engine, 'connect', set_sqlite_pragmas)
+        event.listen(self.engine, 'close', optimize_on_close)
+        self.schema_version = migrate(self.engine)
+        # Своя сессия на поток: фоновые задачи выполняют запросы к LLM (и учет токенов) в потоках
+        self.session = scoped_session(sessionmaker(bind=self.engine))
 
+    @timed(DB_OPERATION_SECONDS, operation='optimize')
+    def optimize(self):
+        """PRAGMA optimize: SQLite сам решает, для каких таблиц обновить статистику (ANALYZE)"""
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA optimize")
+
+    @timed(DB_OPERATION_SECONDS, operation='create_respondent')
     def create_respondent(self, name: str, age: int, profession: str, 
                          trait: str, profile: dict) -> Respondent:
         """Создание нового респондента"""
@@ -52,29 +184,36 @@ class DatabaseManager:
         self.session.commit()
         return respondent
 
-    def create_interview(self, respondent_id: int, hypothesis: str) -> Interview:
+    @timed(DB_OPERATION_SECONDS, operation='create_interview')
+    def create_interview(self, respondent_id: int, hypothesis: str, hypothesis_id: int = None) -> Interview:
         """Создание нового интервью"""
         interview = Interview(
             respondent_id=respondent_id,
             hypothesis=hypothesis,
+            hypothesis_id=hypothesis_id,
             responses=[]
         )
         self.session.add(interview)
         self.session.commit()
         return interview
 
+    @timed(DB_OPERATION_SECONDS, operation='add_response')
     def add_response(self, interview_id: int, response: str):
         """Добавление ответа к интервью"""
         interview = self.session.query(Interview).get(interview_id)
         if interview:
-            responses = interview.responses or []
+            # Новый список: JSON-колонка не отслеживает изменения на месте
+            responses = list(interview.responses or [])
             responses.append({
                 "text": response,
                 "timestamp": datetime.utcnow().isoformat()
             })
             interview.responses = responses
             self.session.commit()
+        else:
+            logger.warning(f"Интервью {interview_id} не найдено (возможно, перенесено в архив), ответ не сохранен")
 
+    @timed(DB_OPERATION_SECONDS, operation='update_analysis')
     def update_analysis(self, interview_id: int, analysis: dict):
         """Обновление результатов анализа интервью"""
         interview = self.session.query(Interview).get(interview_id)
@@ -82,22 +221,135 @@ class DatabaseManager:
             interview.analysis = analysis
             self.session.commit()
 
+    @timed(DB_OPERATION_SECONDS, operation='get_or_create_hypothesis')
+    def get_or_create_hypothesis(self, user_id: int, text: str) -> Hypothesis:
+        """Гипотеза пользователя; повторно введенный текст не создает новую запись"""
+        hypothesis = self.session.query(Hypothesis).filter_by(user_id=user_id, text=text).first()
+        if hypothesis is None:
+            hypothesis = Hypothesis(user_id=user_id, text=text)
+            self.session.add(hypothesis)
+            self.session.commit()
+        return hypothesis
+
+    @timed(DB_OPERATION_SECONDS, operation='get_hypothesis')
+    def get_hypothesis(self, hypothesis_id: int) -> Hypothesis:
+        """Получение гипотезы по ID"""
+        return self.session.query(Hypothesis).get(hypothesis_id)
+
+    @timed(DB_OPERATION_SECONDS, operation='update_hypothesis_features')
+    def update_hypothesis_features(self, hypothesis_id: int, keywords: list = None, embedding: list = None,
+                                   error: str = None):
+        """Сохранение ключевых слов и эмбеддинга гипотезы (или ошибки их расчета)"""
+        hypothesis = self.session.query(Hypothesis).get(hypothesis_id)
+        if hypothesis:
+            if error:
+                hypothesis.status, hypothesis.error = 'failed', error
+            else:
+                hypothesis.keywords, hypothesis.embedding = keywords, embedding
+                hypothesis.status, hypothesis.error = 'ready', None
+            self.session.commit()
+
+    @timed(DB_OPERATION_SECONDS, operation='get_hypothesis_interviews')
+    def get_hypothesis_interviews(self, hypothesis_id: int) -> list:
+        """Все интервью по гипотезе"""
+        return self.session.query(Interview).filter_by(hypothesis_id=hypothesis_id).order_by(Interview.id).all()
+
+    @timed(DB_OPERATION_SECONDS, operation='add_token_usage')
+    def add_token_usage(self, user_id: int, respondent_id: int, interview_id: int, model: str,
+                        prompt_tokens: int, completion_tokens: int, total_tokens: int,
+                        estimated_prompt_tokens: int, cost: float) -> TokenUsage:
+        """Сохранение расхода токенов одного запроса к LLM"""
+        usage = TokenUsage(
+            user_id=user_id,
+            respondent_id=respondent_id,
+            interview_id=interview_id,
+            model=model,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=total_tokens,
+            estimated_prompt_tokens=estimated_prompt_tokens,
+            cost=cost
+        )
+        self.session.add(usage)
+        self.session.commit()
+        return usage
+
+    @timed(DB_OPERATION_SECONDS, operation='get_user_token_total')
+    def get_user_token_total(self, user_id: int) -> int:
+        """Суммарный расход токенов пользователя"""
+        total = self.session.query(func.sum(TokenUsage.total_tokens)).filter_by(user_id=user_id).scalar()
+        return int(total or 0)
+
+    @timed(DB_OPERATION_SECONDS, operation='get_interview_token_total')
+    def get_interview_token_total(self, interview_id: int) -> int:
+        """Суммарный расход токенов интервью"""
+        total = self.session.query(func.sum(TokenUsage.total_tokens)).filter_by(interview_id=interview_id).scalar()
+        return int(total or 0)
+
+    @timed(DB_OPERATION_SECONDS, operation='get_user_usage_summary')
+    def get_user_usage_summary(self, user_id: int) -> dict:
+        """Токены и стоимость пользователя с разбивкой по моделям"""
+        rows = (
+            self.session.query(
+                TokenUsage.model,
+                func.count(TokenUsage.id),
+                func.sum(TokenUsage.prompt_tokens),
+                func.sum(TokenUsage.completion_tokens),
+                func.sum(TokenUsage.cost)
+            )
+            .filter_by(user_id=user_id)
+            .group_by(TokenUsage.model)
+            .all()
+        )
+        return {
+            model: {
+                "requests": requests,
+                "prompt_tokens": int(prompt or 0),
+                "completion_tokens": int(completion or 0),
+                "cost": float(cost or 0.0)
+            }
+            for model, requests, prompt, completion, cost in rows
+        }
+
+    @timed(DB_OPERATION_SECONDS, operation='get_respondent')
     def get_respondent(self, respondent_id: int) -> Respondent:
         """Получение респондента по ID"""
         return self.session.query(Respondent).get(respondent_id)
 
+    @timed(DB_OPERATION_SECONDS, operation='get_interview')
     def get_interview(self, interview_id: int) -> Interview:
         """Получение интервью по ID"""
         return self.session.query(Interview).get(interview_id)
 
+    @timed(DB_OPERATION_SECONDS, operation='get_respondent_interviews')
     def get_respondent_interviews(self, respondent_id: int) -> list:
         """Получение всех интервью респондента"""
         return self.session.query(Interview).filter_by(respondent_id=respondent_id).all()
 
+    @timed(DB_OPERATION_SECONDS, operation='get_all_respondents')
     def get_all_respondents(self) -> list:
         """Получение всех респондентов"""
         return self.session.query(Respondent).all()
 
+    @timed(DB_OPERATION_SECONDS, operation='load_states')
+    def load_states(self, namespace: str) -> dict:
+        """Все сохраненные состояния пространства имен: key -> data"""
+        rows = self.session.query(BotState).filter_by(namespace=namespace).all()
+        return {row.key: row.data for row in rows}
+
+    @timed(DB_OPERATION_SECONDS, operation='save_state')
+    def save_state(self, namespace: str, key: str, data):
+        """Сохранение (или удаление при data=None) одного состояния"""
+        row = self.session.query(BotState).filter_by(namespace=namespace, key=key).first()
+        if data is None:
+            if row:
+                self.session.delete(row)
+        elif row:
+            row.data = data
+        else:
+            self.session.add(BotState(namespace=namespace, key=key, data=data))
+        self.session.commit()
+
 if __name__ == "__main__":
     # Пример использования
     db = DatabaseManager()
@@ -0,0 +1,282 @@
+"""Версионированные миграции схемы sessions.db.
+
+Текущая версия схемы хранится в PRAGMA user_version. При старте применяются
+только недостающие миграции, в одной транзакции под BEGIN IMMEDIATE, поэтому
+одновременно стартующие воркеры кластера не выполнят их дважды.
+Новая миграция добавляется в конец MIGRATIONS; уже выпущенные не меняются.
+
+    python -m Bot_Core.data.migrations [sessions.db]   # обновить и показать планы запросов
+"""
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Схема на момент появления миграций (раньше создавалась create_all).
+# IF NOT EXISTS позволяет обновить существующую базу на месте.
+INITIAL_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS respondents (
+        id INTEGER NOT NULL,
+        name VARCHAR,
+        age INTEGER,
+        profession VARCHAR,
+        trait VARCHAR,
+        profile JSON,
+        created_at DATETIME,
+        PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS interviews (
+        id INTEGER NOT NULL,
+        respondent_id INTEGER,
+        hypothesis VARCHAR,
+        responses JSON,
+        analysis JSON,
+        created_at DATETIME,
+        PRIMARY KEY (id),
+        FOREIGN KEY(respondent_id) REFERENCES respondents (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS token_usage (
+        id INTEGER NOT NULL,
+        user_id INTEGER,
+        respondent_id INTEGER,
+        interview_id INTEGER,
+        model VARCHAR,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        total_tokens INTEGER,
+        estimated_prompt_tokens INTEGER,
+        cost FLOAT,
+        created_at DATETIME,
+        PRIMARY KEY (id),
+        FOREIGN KEY(respondent_id) REFERENCES respondents (id),
+        FOREIGN KEY(interview_id) REFERENCES interviews (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS bot_state (
+        id INTEGER NOT NULL,
+        namespace VARCHAR NOT NULL,
+        "key" VARCHAR NOT NULL,
+        data JSON,
+        updated_at DATETIME,
+        PRIMARY KEY (id),
+        UNIQUE (namespace, "key")
+    )""",
+    """CREATE TABLE IF NOT EXISTS background_jobs (
+        id INTEGER NOT NULL,
+        kind VARCHAR NOT NULL,
+        job_class VARCHAR NOT NULL,
+        priority INTEGER,
+        payload JSON,
+        dedup_key VARCHAR,
+        status VARCHAR,
+        attempts INTEGER,
+        max_attempts INTEGER,
+        progress FLOAT,
+        progress_message VARCHAR,
+        result JSON,
+        error VARCHAR,
+        run_after DATETIME,
+        lease_until DATETIME,
+        worker VARCHAR,
+        created_at DATETIME,
+        updated_at DATETIME,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_background_jobs_dedup_key ON background_jobs (dedup_key)",
+    "CREATE INDEX IF NOT EXISTS ix_background_jobs_status ON background_jobs (status)",
+]
+
+LOOKUP_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_interviews_respondent_id ON interviews (respondent_id)",
+    "CREATE INDEX IF NOT EXISTS ix_interviews_created_at ON interviews (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_respondents_profession ON respondents (profession)",
+    "CREATE INDEX IF NOT EXISTS ix_respondents_trait ON respondents (trait)",
+    "CREATE INDEX IF NOT EXISTS ix_respondents_created_at ON respondents (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_token_usage_user_id ON token_usage (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_token_usage_interview_id ON token_usage (interview_id)",
+    # Захват задачи: WHERE job_class = ? AND status = ? ORDER BY priority, id
+    "CREATE INDEX IF NOT EXISTS ix_background_jobs_claim ON background_jobs (job_class, status, priority, id)",
+]
+
+ARCHIVE_INDEX = [
+    """CREATE TABLE IF NOT EXISTS archive_index (
+        id INTEGER NOT NULL,
+        record_type VARCHAR NOT NULL,
+        record_id INTEGER NOT NULL,
+        respondent_id INTEGER,
+        profession VARCHAR,
+        trait VARCHAR,
+        hypothesis VARCHAR,
+        created_at DATETIME,
+        archived_at DATETIME,
+        segment VARCHAR NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (record_type, record_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_archive_index_respondent_id ON archive_index (respondent_id)",
+    "CREATE INDEX IF NOT EXISTS ix_archive_index_profession ON archive_index (profession)",
+    "CREATE INDEX IF NOT EXISTS ix_archive_index_created_at ON archive_index (created_at)",
+]
+
+HYPOTHESES = [
+    """CREATE TABLE IF NOT EXISTS hypotheses (
+        id INTEGER NOT NULL,
+        user_id INTEGER,
+        text VARCHAR NOT NULL,
+        keywords JSON,
+        embedding JSON,
+        status VARCHAR,
+        error VARCHAR,
+        created_at DATETIME,
+        updated_at DATETIME,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_hypotheses_user_id ON hypotheses (user_id)",
+    "ALTER TABLE interviews ADD COLUMN hypothesis_id INTEGER REFERENCES hypotheses (id)",
+    "CREATE INDEX IF NOT EXISTS ix_interviews_hypothesis_id ON interviews (hypothesis_id)",
+]
+
+# ANALYZE в миграции 2 закреплял статистику почти пустых таблиц, и планировщик выбирал
+# полный просмотр вместо индексов. Статистику теперь обновляет PRAGMA optimize
+# (DatabaseManager.optimize), а устаревшая удаляется.
+DROP_STALE_STATS = [
+    "DROP TABLE IF EXISTS sqlite_stat1",
+]
+
+# Архивация удаляет строки, а без AUTOINCREMENT SQLite выдает освободившиеся id заново:
+# новое интервью получало id архивного (индекс архива, token_usage и current_interview_id
+# в сохраненных user_data начинали указывать не туда). Таблицы пересоздаются с AUTOINCREMENT,
+# счетчик начинается после наибольшего id, в том числе уже ушедшего в архив.
+# Заодно у интервью появляется updated_at — время последнего ответа, по нему считается срок
+# хранения (активное интервью со старой датой создания не архивируется).
+AUTOINCREMENT_IDS = [
+    """CREATE TABLE respondents_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name VARCHAR,
+        age INTEGER,
+        profession VARCHAR,
+        trait VARCHAR,
+        profile JSON,
+        created_at DATETIME
+    )""",
+    """INSERT INTO respondents_new (id, name, age, profession, trait, profile, created_at)
+       SELECT id, name, age, profession, trait, profile, created_at FROM respondents""",
+    "DROP TABLE respondents",
+    "ALTER TABLE respondents_new RENAME TO respondents",
+    "CREATE INDEX ix_respondents_profession ON respondents (profession)",
+    "CREATE INDEX ix_respondents_trait ON respondents (trait)",
+    "CREATE INDEX ix_respondents_created_at ON respondents (created_at)",
+    """CREATE TABLE interviews_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        respondent_id INTEGER REFERENCES respondents (id),
+        hypothesis VARCHAR,
+        hypothesis_id INTEGER REFERENCES hypotheses (id),
+        responses JSON,
+        analysis JSON,
+        created_at DATETIME,
+        updated_at DATETIME
+    )""",
+    """INSERT INTO interviews_new (id, respondent_id, hypothesis, hypothesis_id, responses, analysis,
+                                  created_at, updated_at)
+       SELECT id, respondent_id, hypothesis, hypothesis_id, responses, analysis, created_at,
+              coalesce((SELECT replace(max(json_extract(value, '$.timestamp')), 'T', ' ')
+                        FROM json_each(interviews.responses)), created_at)
+       FROM interviews""",
+    "DROP TABLE interviews",
+    "ALTER TABLE interviews_new RENAME TO interviews",
+    "CREATE INDEX ix_interviews_respondent_id ON interviews (respondent_id)",
+    "CREATE INDEX ix_interviews_created_at ON interviews (created_at)",
+    "CREATE INDEX ix_interviews_updated_at ON interviews (updated_at)",
+    "CREATE INDEX ix_interviews_hypothesis_id ON interviews (hypothesis_id)",
+    "DELETE FROM sqlite_sequence WHERE name IN ('respondents', 'interviews')",
+    """INSERT INTO sqlite_sequence (name, seq) VALUES ('respondents', max(
+        coalesce((SELECT max(id) FROM respondents), 0),
+        coalesce((SELECT max(respondent_id) FROM archive_index), 0)
+    ))""",
+    """INSERT INTO sqlite_sequence (name, seq) VALUES ('interviews', max(
+        coalesce((SELECT max(id) FROM interviews), 0),
+        coalesce((SELECT max(record_id) FROM archive_index WHERE record_type = 'interview'), 0)
+    ))""",
+]
+
+# (версия, описание, SQL-команды)
+MIGRATIONS = [
+    (1, "Исходная схема", INITIAL_SCHEMA),
+    (2, "Индексы для выборок по респонденту, дате, профессии и типу", LOOKUP_INDEXES),
+    (3, "Индекс архива старых интервью", ARCHIVE_INDEX),
+    (4, "Гипотезы с предрассчитанными ключевыми словами", HYPOTHESES),
+    (5, "Сброс статистики планировщика, собранной на пустых таблицах", DROP_STALE_STATS),
+    (6, "AUTOINCREMENT для респондентов и интервью, время последнего ответа", AUTOINCREMENT_IDS),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Частые выборки бота — для проверки, что они идут по индексам
+COMMON_QUERIES = {
+    'get_respondent_interviews': "SELECT * FROM interviews WHERE respondent_id = 1",
+    'get_hypothesis_interviews': "SELECT * FROM interviews WHERE hypothesis_id = 1 ORDER BY id",
+    'interviews_by_period': "SELECT * FROM interviews WHERE created_at >= '2024-01-01' AND created_at < '2024-02-01'",
+    'respondents_by_profession': "SELECT * FROM respondents WHERE profession = 'бухгалтер'",
+    'respondents_by_trait': "SELECT * FROM respondents WHERE trait = 'skeptic'",
+    'get_user_token_total': "SELECT sum(total_tokens) FROM token_usage WHERE user_id = 1",
+    'get_interview_token_total': "SELECT sum(total_tokens) FROM token_usage WHERE interview_id = 1",
+    'claim_job': (
+        "SELECT id FROM background_jobs WHERE job_class = 'generation' AND status = 'pending' "
+        "ORDER BY priority, id LIMIT 5"
+    ),
+}
+
+
+def get_version(connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(engine) -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы"""
+    raw = engine.raw_connection()
+    connection = raw.driver_connection
+    isolation_level = connection.isolation_level
+    # Управляем транзакцией сами: DDL в SQLite транзакционен
+    connection.isolation_level = None
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = get_version(connection)
+            for target, description, statements in MIGRATIONS:
+                if target <= version:
+                    continue
+                logger.info(f"Миграция схемы {version} -> {target}: {description}")
+                for statement in statements:
+                    connection.execute(statement)
+                connection.execute(f"PRAGMA user_version = {target}")
+                version = target
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        if version > LATEST_VERSION:
+            logger.warning(f"Версия схемы {version} новее кода ({LATEST_VERSION})")
+        return version
+    finally:
+        connection.isolation_level = isolation_level
+        raw.close()
+
+
+def explain(engine, sql: str) -> list:
+    """План выполнения запроса (EXPLAIN QUERY PLAN)"""
+    raw = engine.raw_connection()
+    try:
+        return [row[-1] for row in raw.driver_connection.execute(f"EXPLAIN QUERY PLAN {sql}")]
+    finally:
+        raw.close()
+
+
+if __name__ == "__main__":
+    from Bot_Core.data.database import DatabaseManager
+
+    logging.basicConfig(level=logging.INFO)
+    db = DatabaseManager(sys.argv[1] if len(sys.argv) > 1 else "sessions.db")
+    raw = db.engine.raw_connection()
+    print(f"Версия схемы: {get_version(raw.driver_connection)}")
+    raw.close()
+    for name, sql in COMMON_QUERIES.items():
+        print(f"{name}: {'; '.join(explain(db.engine, sql))}")
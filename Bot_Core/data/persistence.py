@@ -0,0 +1,102 @@
+import copy
+import json
+import logging
+from typing import Dict, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from Bot_Core.data.database import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = 'user_data'
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранение user_data и состояний ConversationHandler в sessions.db.
+
+    Благодаря этому интервью переживает перезапуск процесса, а воркеры
+    кластера (см. Bot_Core/cluster.py) работают с общим состоянием.
+    Данные должны сериализоваться в JSON, поэтому в user_data кладутся
+    только идентификаторы, а не ORM-объекты.
+    """
+
+    def __init__(self, db: DatabaseManager, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = db
+        self._user_data: Optional[Dict[int, dict]] = None
+        self._conversations: Dict[str, dict] = {}
+
+    @staticmethod
+    def _conversation_namespace(name: str) -> str:
+        return f'conversation:{name}'
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        if self._user_data is None:
+            self._user_data = {int(k): v for k, v in self.db.load_states(USER_DATA).items()}
+        return copy.deepcopy(self._user_data)
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        if name not in self._conversations:
+            stored = self.db.load_states(self._conversation_namespace(name))
+            self._conversations[name] = {tuple(json.loads(k)): v for k, v in stored.items()}
+        return dict(self._conversations[name])
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        conversations = self._conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self.db.save_state(self._conversation_namespace(name), json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if self._user_data is None:
+            self._user_data = {}
+        if self._user_data.get(user_id) == data:
+            return
+        self._user_data[user_id] = copy.deepcopy(data)
+        self.db.save_state(USER_DATA, str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if self._user_data is not None:
+            self._user_data.pop(user_id, None)
+        self.db.save_state(USER_DATA, str(user_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        logger.info("Состояние бота сохранено в БД")
@@ -3,39 +3,44 @@ import os
 import sys
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters
-from telegram.error import TimedOut, NetworkError, Forbidden, TelegramError
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, TypeHandler, filters
+from telegram.error import TimedOut, NetworkError, Forbidden, TelegramError, BadRequest
+from telegram.request import HTTPXRequest
 import asyncio
 import traceback
 from datetime import datetime
+from typing import Optional, Tuple
 
 # Добавляем родительскую директорию в PYTHONPATH
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from Bot_Core.responders.generator import generate_responder, generate_interview_response
+from Bot_Core.responders.generator import (
+    generate_responder, generate_interview_turn, generate_llm_response, build_responder_prompt
+)
+from Bot_Core.responders.answer_cache import AnswerCache
+from Bot_Core.responders.tokens import BudgetExceeded, configure_accounting, set_usage_context
 from Bot_Core.validation.validator import ProfileValidator
 from Bot_Core.data.database import DatabaseManager
+from Bot_Core.data.archive import InterviewArchiver
+from Bot_Core.data.persistence import SQLitePersistence
+from Bot_Core.utils.instrumented_request import InstrumentedRequest
+from Bot_Core.utils.logging_setup import setup_logging
+from Bot_Core.utils.outbox import FloodControlLimiter, Outbox
+from Bot_Core.utils.metrics import UPDATES_TOTAL, new_trace_id, format_stats, start_metrics_server
+from Bot_Core.utils.task_queue import JOB_CLASSES, TaskQueue, PermanentJobError, run_blocking
+from Bot_Core.simulation import InterviewSimulation, format_report
 
 # Загрузка переменных окружения
 load_dotenv()
 
-# Настройка логирования
-log_file = f"bot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file, encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# Настройка логирования (очередь + фоновый поток записи, см. LOG_* в README)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Логируем важную информацию при запуске
 logger.info("Бот запускается...")
 logger.info(f"Версия Python: {sys.version}")
 logger.info(f"Рабочая директория: {os.getcwd()}")
-logger.info(f"Файл лога: {log_file}")
 
 # Проверяем наличие токена
 if not os.getenv('TELEGRAM_BOT_TOKEN'):
@@ -50,19 +55,457 @@ CHOOSING_RESPONDENT, WAITING_PROFESSION, WAITING_AGE, INTERVIEW, HYPOTHESIS_INPU
 # Инициализация компонентов
 db = DatabaseManager()
 validator = ProfileValidator()
+accountant = configure_accounting(db)
+answer_cache = AnswerCache.from_env()
+# Неблокирующая отправка ответов (статус -> ответ одним сообщением, повторы в фоне)
+outbox = Outbox()
+# Кэш ответов выключен по умолчанию; включается для каждого интервью командой /cache
+ANSWER_CACHE_DEFAULT = os.getenv('ANSWER_CACHE_ENABLED', '0').lower() not in ('0', 'false', 'no')
+
+# Администраторы, которым доступна команда /stats
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x}
+
+# Фоновые задачи: генерация панелей и анализ выполняются вне обработчиков (см. JOB_POOLS в README)
+task_queue = TaskQueue(db.engine, pools=TaskQueue.pools_from_env())
+PANEL_MAX_SIZE = int(os.getenv('PANEL_MAX_SIZE', '10'))
+PANEL_TRAITS = ('skeptic', 'chatty')
+SIMULATION_MAX_RESPONDENTS = int(os.getenv('SIMULATION_MAX_RESPONDENTS', '20'))
+SIMULATION_QUESTIONS = int(os.getenv('SIMULATION_QUESTIONS', '5'))
+SIMULATION_CONCURRENCY = int(os.getenv('SIMULATION_CONCURRENCY', '4'))
+COMPARISON_MAX_LINES = 20
+_nlp_processor = None
+
+def get_nlp_processor():
+    """NLP-модели загружаются один раз, при первом анализе"""
+    global _nlp_processor
+    if _nlp_processor is None:
+        from Bot_Core.analytics.nlp_processor import NLPProcessor
+        _nlp_processor = NLPProcessor()
+    return _nlp_processor
+
+async def run_panel_job(payload: dict, job):
+    """Задача: генерация панели респондентов одной профессии"""
+    set_usage_context(user_id=payload.get('user_id'))
+    count = payload['count']
+    created = []
+    for i in range(count):
+        trait = PANEL_TRAITS[i % len(PANEL_TRAITS)]
+        age = 22 + (i * 17) % 45
+        # Запрос к модели блокирующий — выполняем в потоке, чтобы не задерживать ответы в интервью
+        profile = await run_blocking(
+            generate_llm_response, build_responder_prompt(age, payload['profession'], trait)
+        )
+        if "error" in profile:
+            raise RuntimeError(f"{profile['error']}: {profile.get('details', '')[:200]}")
+        # Запись в базу тоже в потоке: при занятой блокировке она ждет до busy_timeout
+        respondent_id = await run_blocking(create_respondent_id, profile, trait)
+        created.append({'id': respondent_id, 'name': profile['name'], 'age': profile['age'], 'trait': trait})
+        await job.progress((i + 1) / count, f"Создано {i + 1} из {count}: {profile['name']}")
+    return {'respondents': created}
+
+def create_respondent_id(profile: dict, trait: str) -> int:
+    return db.create_respondent(
+        name=profile['name'],
+        age=profile['age'],
+        profession=profile['profession'],
+        trait=trait,
+        profile=profile
+    ).id
+
+def interview_answers(interview) -> list:
+    """Ответы интервью для анализа (повторы из кэша не учитываются)"""
+    # db.add_response сохраняет ход интервью в поле "text"
+    turns = [r.get('text') for r in interview.responses or []]
+    return [t['answer'] for t in turns if isinstance(t, dict) and t.get('answer') and not t.get('cached')]
+
+async def load_nlp_processor():
+    try:
+        return await run_blocking(get_nlp_processor)
+    except ImportError as e:
+        raise PermanentJobError(f"NLP-модели недоступны: {e}")
+
+# Загрузка данных для задач: вызываются через run_blocking и возвращают простые структуры,
+# а не объекты ORM, привязанные к сессии другого потока
+
+def load_hypothesis(hypothesis_id: int) -> Optional[dict]:
+    hypothesis = db.get_hypothesis(hypothesis_id)
+    if hypothesis is None:
+        return None
+    return {'id': hypothesis.id, 'text': hypothesis.text, 'status': hypothesis.status,
+            'keywords': hypothesis.keywords}
+
+def load_interview(interview_id: int) -> Optional[dict]:
+    interview = db.get_interview(interview_id)
+    if interview is None:
+        return None
+    return {'id': interview.id, 'hypothesis': interview.hypothesis, 'hypothesis_id': interview.hypothesis_id,
+            'answers': interview_answers(interview)}
+
+def load_hypothesis_answers(hypothesis_id: int) -> dict:
+    """Ответы всех интервью гипотезы: interview_id -> ответы"""
+    interviews = {}
+    for interview in db.get_hypothesis_interviews(hypothesis_id):
+        answers = interview_answers(interview)
+        if answers:
+            interviews[interview.id] = answers
+    return interviews
+
+def save_hypothesis(user_id: int, text: str) -> Tuple[int, str]:
+    hypothesis = db.get_or_create_hypothesis(user_id, text)
+    return hypothesis.id, hypothesis.status
+
+def hypothesis_features(hypothesis_id: int):
+    """Ключевые слова и эмбеддинг гипотезы из базы (при необходимости рассчитываются)"""
+    from Bot_Core.analytics.nlp_processor import ensure_hypothesis_features
+    return ensure_hypothesis_features(db, get_nlp_processor(), hypothesis_id)
+
+async def run_hypothesis_features_job(payload: dict, job):
+    """Задача: расчет ключевых слов и эмбеддинга новой гипотезы"""
+    hypothesis = await run_blocking(load_hypothesis, payload['hypothesis_id'])
+    if hypothesis is None:
+        raise PermanentJobError("Гипотеза не найдена")
+    if hypothesis['status'] == 'ready':
+        return {'keywords': hypothesis['keywords']}
+    try:
+        processor = await load_nlp_processor()
+    except PermanentJobError as e:
+        await run_blocking(db.update_hypothesis_features, hypothesis['id'], error=str(e))
+        raise
+    features = await run_blocking(processor.hypothesis_features, hypothesis['text'])
+    await run_blocking(db.update_hypothesis_features, hypothesis['id'], **features)
+    return {'keywords': features['keywords']}
+
+async def run_analysis_job(payload: dict, job):
+    """Задача: анализ ответов интервью относительно гипотезы"""
+    interview = await run_blocking(load_interview, payload['interview_id'])
+    if interview is None:
+        raise PermanentJobError("Интервью не найдено")
+    answers = interview['answers']
+    if not answers:
+        raise PermanentJobError("В интервью пока нет ответов")
+
+    await job.progress(0.1, "Загрузка NLP-моделей")
+    processor = await load_nlp_processor()
+    keywords = None
+    if interview['hypothesis_id']:
+        # Ключевые слова гипотезы посчитаны заранее и общие для всех ее интервью
+        keywords, _ = await run_blocking(hypothesis_features, interview['hypothesis_id'])
+    await job.progress(0.4, f"Анализ {len(answers)} ответов")
+    insights = await run_blocking(processor.generate_insights, answers, interview['hypothesis'], keywords)
+    await run_blocking(db.update_analysis, interview['id'], insights)
+    return insights
+
+async def run_comparison_job(payload: dict, job):
+    """Задача: сравнение всех интервью по одной гипотезе"""
+    hypothesis = await run_blocking(load_hypothesis, payload['hypothesis_id'])
+    if hypothesis is None:
+        raise PermanentJobError("Гипотеза не найдена")
+    interviews = await run_blocking(load_hypothesis_answers, hypothesis['id'])
+    if not interviews:
+        raise PermanentJobError("По этой гипотезе пока нет интервью с ответами")
+
+    await job.progress(0.1, "Загрузка NLP-моделей")
+    processor = await load_nlp_processor()
+    keywords, embedding = await run_blocking(hypothesis_features, hypothesis['id'])
+    await job.progress(0.3, f"Сравнение {len(interviews)} интервью")
+    result = await run_blocking(
+        processor.compare_interviews, interviews, hypothesis['text'], keywords, embedding
+    )
+    return {'hypothesis': hypothesis['text'], **result}
+
+async def run_simulation_job(payload: dict, job):
+    """Задача: симуляция исследования гипотезы на сгенерированных респондентах"""
+    async def progress(done: int, total: int, name: str):
+        # Последние 10% — анализ ответов
+        await job.progress(0.9 * done / total, f"Проведено интервью: {done} из {total} ({name})")
+
+    simulation = InterviewSimulation(
+        db, payload['hypothesis'], payload['profession'],
+        hypothesis_id=payload.get('hypothesis_id'),
+        respondents=payload['count'],
+        questions=SIMULATION_QUESTIONS,
+        concurrency=SIMULATION_CONCURRENCY,
+        user_id=payload.get('user_id'),
+        progress=progress,
+        processor_factory=get_nlp_processor
+    )
+    report = await simulation.run()
+    if not report['interviews']:
+        raise RuntimeError("Не удалось провести ни одного интервью")
+    return report
+
+# Перенос старых интервью в архив (см. RETENTION_DAYS в README)
+archiver = InterviewArchiver.from_env(db.engine)
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', '24'))
+
+async def run_retention_job(payload: dict, job):
+    """Задача: архивация старых интервью и сжатие базы"""
+    await job.progress(0.1, "Перенос старых интервью в архив")
+    return await run_blocking(archiver.run)
+
+DB_OPTIMIZE_INTERVAL_HOURS = float(os.getenv('DB_OPTIMIZE_INTERVAL_HOURS', '6'))
+
+async def schedule_optimize():
+    """Периодический PRAGMA optimize: статистика планировщика растет вместе с базой"""
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_INTERVAL_HOURS * 3600)
+        try:
+            await asyncio.to_thread(db.optimize)
+        except Exception as e:
+            logger.warning(f"PRAGMA optimize не выполнен: {e}")
+
+async def schedule_retention():
+    """Периодическая постановка архивации в очередь (дедупликация не даст запустить ее дважды)"""
+    while True:
+        await task_queue.enqueue('retention', {}, dedup_key='retention')
+        await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+task_queue.register('respondent_panel', run_panel_job, job_class='generation', max_attempts=2)
+task_queue.register('interview_analysis', run_analysis_job, job_class='analytics')
+task_queue.register('hypothesis_features', run_hypothesis_features_job, job_class='analytics')
+task_queue.register('hypothesis_comparison', run_comparison_job, job_class='analytics')
+task_queue.register('simulation', run_simulation_job, job_class='generation', max_attempts=1)
+task_queue.register('retention', run_retention_job, job_class='analytics', max_attempts=1)
+
+def format_job_status(job: dict) -> str:
+    """Текст статусного сообщения фоновой задачи"""
+    if job['status'] == 'pending':
+        if job['error']:
+            return f"⚠️ Ошибка: {job['error']}\nПовторная попытка скоро начнется..."
+        return "⏳ Задача в очереди..."
+    if job['status'] == 'running':
+        return f"⚙️ {job['progress_message'] or 'Выполняется'} ({job['progress'] * 100:.0f}%)"
+    if job['status'] == 'failed':
+        return f"❌ Не удалось выполнить задачу: {job['error']}"
+
+    result = job['result'] or {}
+    if job['kind'] == 'respondent_panel':
+        lines = [f"✅ Панель готова ({len(result['respondents'])} респондентов):"]
+        lines += [f"• {r['name']}, {r['age']} ({r['trait']}) — #{r['id']}" for r in result['respondents']]
+        return "\n".join(lines)
+    if job['kind'] == 'simulation':
+        return "✅ Симуляция завершена\n\n" + format_report(result)
+    if job['kind'] == 'hypothesis_comparison':
+        lines = [
+            f"📊 Сравнение интервью по гипотезе «{result['hypothesis']}»:",
+            f"Подтверждение гипотезы в среднем: {result['confirmation_rate'] * 100:.0f}%",
+            f"Ключевые слова гипотезы: {', '.join(result['hypothesis_keywords']) or '—'}",
+            "",
+        ]
+        for item in result['interviews'][:COMPARISON_MAX_LINES]:
+            similarity = f", близость {item['similarity']:.2f}" if item.get('similarity') is not None else ""
+            lines.append(
+                f"• #{item['interview_id']}: {item['confirmation_rate'] * 100:.0f}% "
+                f"из {item['responses']} ответов{similarity}"
+            )
+        if len(result['interviews']) > COMPARISON_MAX_LINES:
+            lines.append(f"... и еще {len(result['interviews']) - COMPARISON_MAX_LINES}")
+        return "\n".join(lines)
+    lines = [
+        "📊 Анализ интервью:",
+        f"Подтверждение гипотезы: {result.get('confirmation_rate', 0) * 100:.0f}%",
+        f"Ключевые слова гипотезы: {', '.join(result.get('hypothesis_keywords', [])) or '—'}",
+    ]
+    if result.get('key_insights'):
+        lines.append("\nКлючевые инсайты:")
+        lines += [f"• {insight}" for insight in result['key_insights']]
+    return "\n".join(lines)
+
+async def edit_job_status(bot, chat_id: int, message_id: int, job: dict):
+    try:
+        await bot.edit_message_text(format_job_status(job), chat_id=chat_id, message_id=message_id)
+    except BadRequest as e:
+        # "Message is not modified" и удаленные сообщения не мешают выполнению задачи
+        logger.debug(f"Статус задачи #{job['id']} не обновлен: {e}")
+
+async def enqueue_with_status(status_message, kind: str, payload: dict, dedup_key: str):
+    """Ставит задачу в очередь; статусное сообщение обновляется по мере выполнения"""
+    payload['notify'] = {'chat_id': status_message.chat_id, 'message_id': status_message.message_id}
+    job = await task_queue.enqueue(kind, payload, dedup_key=dedup_key)
+    if job.get('duplicate'):
+        # Такая задача уже выполняется: следим за ней из нового сообщения
+        bot = status_message.get_bot()
+        async def follow(snapshot):
+            await edit_job_status(bot, status_message.chat_id, status_message.message_id, snapshot)
+        task_queue.subscribe(job['id'], follow)
+        await follow(job)
+    return job
+
+async def assign_trace_id(update: Update, context):
+    """Присваивает апдейту trace_id, который попадает в логи и дочерние задачи"""
+    trace_id = new_trace_id()
+    kind = 'callback_query' if update.callback_query else 'message' if update.message else 'other'
+    UPDATES_TOTAL.inc(kind=kind)
+    logger.debug(f"Апдейт {update.update_id} ({kind}) получил trace_id {trace_id}")
+
+async def cache_command(update: Update, context):
+    """Обработчик команды /cache [on|off]: кэш ответов для текущего интервью"""
+    enabled = context.user_data.get('answer_cache_enabled', ANSWER_CACHE_DEFAULT)
+    if context.args:
+        enabled = context.args[0].lower() in ('on', '1', 'вкл', 'да')
+    else:
+        enabled = not enabled
+    context.user_data['answer_cache_enabled'] = enabled
+    await update.message.reply_text(
+        "♻️ Повторные вопросы будут получать сохраненные ответы." if enabled
+        else "🎲 Кэш выключен: каждый вопрос получает новый ответ модели."
+    )
+
+async def usage_command(update: Update, context):
+    """Обработчик команды /usage: расход токенов и стоимость пользователя"""
+    user_id = update.effective_user.id
+    summary = db.get_user_usage_summary(user_id)
+    if not summary:
+        await update.message.reply_text("Запросов к модели пока не было.")
+        return
+    lines = ["🧮 Расход токенов:"]
+    for model, item in summary.items():
+        lines.append(
+            f"• {model}: {item['requests']} запросов, "
+            f"{item['prompt_tokens']} + {item['completion_tokens']} токенов, ${item['cost']:.4f}"
+        )
+    if accountant.user_budget:
+        lines.append(f"\nИспользовано {accountant.user_total(user_id)} из {accountant.user_budget} токенов")
+    await update.message.reply_text("\n".join(lines))
+
+async def panel_command(update: Update, context):
+    """Обработчик команды /panel <количество> <профессия>: фоновая генерация панели"""
+    if len(context.args) < 2 or not context.args[0].isdigit() or int(context.args[0]) < 1:
+        await update.message.reply_text(
+            f"Использование: /panel <количество до {PANEL_MAX_SIZE}> <профессия>\n"
+            "Например: /panel 5 бухгалтер"
+        )
+        return
+    count = min(int(context.args[0]), PANEL_MAX_SIZE)
+    profession = ' '.join(context.args[1:])
+    user_id = update.effective_user.id
+    status = await update.message.reply_text(f"⏳ Панель из {count} респондентов поставлена в очередь...")
+    await enqueue_with_status(
+        status, 'respondent_panel',
+        {'user_id': user_id, 'count': count, 'profession': profession},
+        dedup_key=f'panel:{user_id}:{profession.lower()}:{count}'
+    )
+
+async def request_analysis(message, context):
+    """Постановка анализа текущего интервью в очередь"""
+    interview_id = context.user_data.get('current_interview_id')
+    if not interview_id:
+        await message.reply_text("Сначала проведите интервью: создайте респондента и задайте ему вопросы.")
+        return
+    status = await message.reply_text("⏳ Анализ интервью поставлен в очередь...")
+    await enqueue_with_status(
+        status, 'interview_analysis', {'interview_id': interview_id}, dedup_key=f'analysis:{interview_id}'
+    )
+
+async def analysis_command(update: Update, context):
+    """Обработчик команды /analysis"""
+    await request_analysis(update.message, context)
+
+async def simulate_command(update: Update, context):
+    """Обработчик команды /simulate [количество] <профессия>: запрос гипотезы для симуляции"""
+    args = list(context.args)
+    count = min(SIMULATION_MAX_RESPONDENTS, 10)
+    if args and args[0].isdigit():
+        count = max(1, min(int(args.pop(0)), SIMULATION_MAX_RESPONDENTS))
+    if not args:
+        await update.message.reply_text(
+            f"Использование: /simulate [количество до {SIMULATION_MAX_RESPONDENTS}] <профессия>\n"
+            "Например: /simulate 10 бухгалтер"
+        )
+        return ConversationHandler.END
+    context.user_data['simulation'] = {'count': count, 'profession': ' '.join(args)}
+    await update.message.reply_text(
+        f"🧪 Симуляция: {count} интервью с респондентами ({' '.join(args)}).\n\n"
+        "Сформулируйте гипотезу, которую нужно проверить:"
+    )
+    return HYPOTHESIS_INPUT
+
+async def hypothesis_command(update: Update, context):
+    """Обработчик команды /hypothesis: ввод гипотезы для следующих интервью"""
+    context.user_data.pop('simulation', None)
+    current = context.user_data.get('hypothesis')
+    await update.message.reply_text(
+        (f"Текущая гипотеза: {current}\n\n" if current else "")
+        + "Сформулируйте гипотезу, которую нужно проверить:"
+    )
+    return HYPOTHESIS_INPUT
+
+async def handle_hypothesis(update: Update, context):
+    """Обработчик ввода гипотезы: сохранение и, для /simulate, постановка симуляции в очередь"""
+    text = update.message.text.strip()
+    user_id = update.effective_user.id
+    hypothesis_id, hypothesis_status = await run_blocking(save_hypothesis, user_id, text)
+    context.user_data['hypothesis'] = text
+    context.user_data['hypothesis_id'] = hypothesis_id
+    if hypothesis_status != 'ready':
+        # Ключевые слова и эмбеддинг считаются один раз, пока пользователь проводит интервью
+        await task_queue.enqueue(
+            'hypothesis_features', {'hypothesis_id': hypothesis_id},
+            priority=JOB_CLASSES['analytics'] - 5, dedup_key=f'hypothesis_features:{hypothesis_id}'
+        )
+
+    params = context.user_data.pop('simulation', None)
+    if params:
+        status = await update.message.reply_text(
+            f"⏳ Симуляция из {params['count']} интервью поставлена в очередь..."
+        )
+        payload = {'user_id': user_id, 'hypothesis': text, 'hypothesis_id': hypothesis_id, **params}
+        await enqueue_with_status(
+            status, 'simulation', payload, dedup_key=TaskQueue.default_dedup_key('simulation', payload)
+        )
+        return ConversationHandler.END
+
+    if context.user_data.get('current_respondent_id'):
+        # Следующий вопрос начнет новое интервью, уже по этой гипотезе
+        context.user_data.pop('current_interview_id', None)
+        await update.message.reply_text(
+            "✅ Гипотеза сохранена. Следующий вопрос респонденту начнет новое интервью по ней."
+        )
+        return INTERVIEW
+    await update.message.reply_text(
+        "✅ Гипотеза сохранена. Выберите действие:", reply_markup=main_menu_markup()
+    )
+    return CHOOSING_RESPONDENT
+
+async def compare_command(update: Update, context):
+    """Обработчик команды /compare: сравнение всех интервью по текущей гипотезе"""
+    hypothesis_id = context.user_data.get('hypothesis_id')
+    if not hypothesis_id:
+        await update.message.reply_text("Сначала задайте гипотезу командой /hypothesis.")
+        return
+    status = await update.message.reply_text("⏳ Сравнение интервью поставлено в очередь...")
+    await enqueue_with_status(
+        status, 'hypothesis_comparison', {'hypothesis_id': hypothesis_id},
+        dedup_key=f'comparison:{hypothesis_id}'
+    )
+
+async def stats_command(update: Update, context):
+    """Обработчик команды /stats (только для администраторов)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        logger.warning(f"Пользователь {update.effective_user.id} запросил /stats без прав")
+        return
+    await update.message.reply_text("📈 Метрики бота:\n\n" + format_stats())
+
+def main_menu_markup() -> InlineKeyboardMarkup:
+    keyboard = [
+        [
+            InlineKeyboardButton("Создать респондента", callback_data='new_responder'),
+            InlineKeyboardButton("Начать интервью", callback_data='start_interview')
+        ],
+        [
+            InlineKeyboardButton("Задать гипотезу", callback_data='set_hypothesis'),
+            InlineKeyboardButton("Анализ результатов", callback_data='analysis')
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
 
 async def start(update: Update, context):
     """Обработчик команды /start"""
     try:
         logger.info(f"Получена команда /start от пользователя {update.effective_user.id}")
-        keyboard = [
-            [
-                InlineKeyboardButton("Создать респондента", callback_data='new_responder'),
-                InlineKeyboardButton("Начать интервью", callback_data='start_interview')
-            ],
-            [InlineKeyboardButton("Анализ результатов", callback_data='analysis')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # /start завершает текущее интервью: следующий вопрос начнет новое
+        context.user_data.pop('current_interview_id', None)
+        reply_markup = main_menu_markup()
         
         await update.message.reply_text(
             "👋 Добро пожаловать в Custos AI Bot!\n\n"
@@ -114,6 +557,15 @@ async def button_handler(update: Update, context):
                 "Укажите профессию респондента (например: бухгалтер, product manager, разработчик):"
             )
             return WAITING_PROFESSION
+
+        elif query.data == 'set_hypothesis':
+            context.user_data.pop('simulation', None)
+            await query.message.reply_text("Сформулируйте гипотезу, которую нужно проверить:")
+            return HYPOTHESIS_INPUT
+
+        elif query.data == 'analysis':
+            await request_analysis(query.message, context)
+            return CHOOSING_RESPONDENT
     except Exception as e:
         logger.error(f"Ошибка в обработчике button_handler: {str(e)}")
         logger.error(traceback.format_exc())
@@ -154,10 +606,11 @@ async def handle_age(update: Update, context):
         context.user_data['age'] = age
         logger.info(f"Получен возраст: {age}")
 
-        # Создаем респондента
-        await update.message.reply_text("🤖 Генерирую респондента...")
+        # Создаем респондента; статусное сообщение затем заменяется результатом
+        status = outbox.status(context.bot, update.effective_chat.id, "🤖 Генерирую респондента...")
         
         try:
+            set_usage_context(user_id=update.effective_user.id)
             result = await generate_responder(
                 age=context.user_data['age'],
                 profession=context.user_data['profession'],
@@ -166,7 +619,7 @@ async def handle_age(update: Update, context):
             
             if not result['success']:
                 logger.error(f"Ошибка при создании респондента: {result['message']}")
-                await update.message.reply_text(result['message'])
+                status.resolve(result['message'])
                 return CHOOSING_RESPONDENT
 
             profile = result['data']
@@ -180,19 +633,19 @@ async def handle_age(update: Update, context):
                 profile=profile
             )
             
-            # Сохраняем ID респондента в контексте
+            # Сохраняем ID респондента в контексте; новый респондент — новое интервью
             context.user_data['current_respondent_id'] = respondent.id
+            context.user_data.pop('current_interview_id', None)
+            context.user_data.pop('answer_cache_enabled', None)
             
             # Отправляем информацию о респонденте
-            await update.message.reply_text(result['message'])
+            status.resolve(result['message'])
             return INTERVIEW
 
         except Exception as e:
             logger.error(f"Ошибка при генерации респондента: {str(e)}")
             logger.error(traceback.format_exc())
-            await update.message.reply_text(
-                "❌ Произошла ошибка при создании респондента. Попробуйте еще раз."
-            )
+            status.resolve("❌ Произошла ошибка при создании респондента. Попробуйте еще раз.")
             return CHOOSING_RESPONDENT
 
     except Exception as e:
@@ -223,38 +676,52 @@ async def handle_interview_message(update: Update, context):
             
         # Генерируем ответ от респондента
         try:
-            await update.message.reply_text(
-                "🤔 Думаю над ответом..."
-            )
-            
-            answer = await generate_interview_response(question, respondent.profile)
+            status = outbox.status(context.bot, update.effective_chat.id, "🤔 Думаю над ответом...")
             
-            # Сохраняем ответ в базу данных
-            current_interview = context.user_data.get('current_interview')
-            if not current_interview:
+            interview_id = context.user_data.get('current_interview_id')
+            if not interview_id:
                 # Создаем новое интервью, если его нет
-                current_interview = db.create_interview(
+                interview_id = db.create_interview(
                     respondent_id=respondent_id,
-                    hypothesis=context.user_data.get('hypothesis', 'Не указана')
-                )
-                context.user_data['current_interview'] = current_interview
+                    hypothesis=context.user_data.get('hypothesis', 'Не указана'),
+                    hypothesis_id=context.user_data.get('hypothesis_id')
+                ).id
+                context.user_data['current_interview_id'] = interview_id
+            
+            set_usage_context(
+                user_id=update.effective_user.id,
+                respondent_id=respondent_id,
+                interview_id=interview_id
+            )
+            use_cache = context.user_data.get('answer_cache_enabled', ANSWER_CACHE_DEFAULT)
+            turn = await generate_interview_turn(
+                question, respondent.profile, respondent_id,
+                answer_cache=answer_cache if use_cache else None
+            )
             
             # Добавляем ответ к интервью
-            db.add_response(current_interview.id, {
+            db.add_response(interview_id, {
                 "question": question,
-                "answer": answer,
+                **turn,
                 "timestamp": datetime.now().isoformat()
             })
             
-            await update.message.reply_text(answer)
+            status.resolve(turn["answer"])
             return INTERVIEW
             
+        except BudgetExceeded as e:
+            logger.warning(f"Пользователь {update.effective_user.id}: {e}")
+            if e.scope == 'interview':
+                hint = "Начните новое интервью через /start или обратитесь к администратору."
+            else:
+                hint = "Обратитесь к администратору."
+            scope = "интервью" if e.scope == 'interview' else "вашего аккаунта"
+            status.resolve(f"⛔️ Исчерпан лимит токенов для {scope} ({e.used}/{e.limit}). {hint}")
+            return INTERVIEW
         except Exception as e:
             logger.error(f"Ошибка при генерации ответа: {str(e)}")
             logger.error(traceback.format_exc())
-            await update.message.reply_text(
-                "❌ Произошла ошибка при генерации ответа. Попробуйте задать вопрос еще раз."
-            )
+            status.resolve("❌ Произошла ошибка при генерации ответа. Попробуйте задать вопрос еще раз.")
             return INTERVIEW
             
     except Exception as e:
@@ -267,14 +734,12 @@ async def error_handler(update: Update, context):
     logger.error(f"Update {update} вызвал ошибку {context.error}")
     logger.error(traceback.format_exc())
     
+    # Повторы отправки выполняют Outbox и FloodControlLimiter, опрос — сам Updater;
+    # здесь только логируем, не задерживая обработку других апдейтов
     if isinstance(context.error, TimedOut):
         logger.warning("Ошибка таймаута соединения")
-        logger.info("Переподключение через 1 секунду...")
-        await asyncio.sleep(1)
     elif isinstance(context.error, NetworkError):
         logger.warning("Ошибка сети")
-        logger.info("Переподключение через 5 секунд...")
-        await asyncio.sleep(5)
     elif isinstance(context.error, Forbidden):
         logger.error("Ошибка доступа к боту")
         logger.error("Проверьте права бота и токен")
@@ -284,52 +749,126 @@ async def error_handler(update: Update, context):
         logger.error(f"Неизвестная ошибка: {context.error}")
         logger.error(traceback.format_exc())
 
+async def on_startup(application: Application):
+    """Запуск HTTP-эндпоинта метрик и воркеров фоновых задач вместе с ботом"""
+    port = os.getenv('METRICS_PORT', '9108')
+    if port:
+        application.bot_data['metrics_runner'] = await start_metrics_server(
+            os.getenv('METRICS_HOST', '127.0.0.1'), int(port)
+        )
+
+    async def notify(job: dict):
+        target = (job['payload'] or {}).get('notify')
+        if target:
+            await edit_job_status(application.bot, target['chat_id'], target['message_id'], job)
+    application.bot_data['job_listener'] = notify
+    task_queue.add_listener(notify)
+    task_queue.start()
+    if archiver.enabled:
+        application.bot_data['retention_task'] = asyncio.create_task(schedule_retention())
+    if DB_OPTIMIZE_INTERVAL_HOURS > 0:
+        application.bot_data['optimize_task'] = asyncio.create_task(schedule_optimize())
+
+async def on_stop(application: Application):
+    """Остановка фоновой работы после application.stop(), пока HTTP-клиент бота еще открыт"""
+    await outbox.drain()
+    for name in ('retention_task', 'optimize_task'):
+        task = application.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    await task_queue.stop()
+    await asyncio.to_thread(db.optimize)
+    listener = application.bot_data.pop('job_listener', None)
+    if listener:
+        task_queue.remove_listener(listener)
+    runner = application.bot_data.pop('metrics_runner', None)
+    if runner:
+        await runner.cleanup()
+
+def build_application(token: str, request=None, persistence=None, rate_limiter=None) -> Application:
+    """Сборка приложения со всеми обработчиками.
+
+    ``request`` позволяет подменить HTTP-транспорт Telegram (используется в бенчмарках),
+    ``persistence`` — хранилище user_data и состояний диалога, ``rate_limiter`` —
+    ограничение частоты запросов (для настоящего Telegram по умолчанию FloodControlLimiter).
+    """
+    if request is None:
+        # HTTP-клиент с расширенными таймаутами
+        request = HTTPXRequest(connection_pool_size=256, connect_timeout=30, read_timeout=30, write_timeout=30)
+        get_updates_request = HTTPXRequest(connect_timeout=30, read_timeout=30, write_timeout=30)
+        if rate_limiter is None:
+            rate_limiter = FloodControlLimiter.from_env()
+    else:
+        get_updates_request = request
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(InstrumentedRequest(request))
+        .get_updates_request(InstrumentedRequest(get_updates_request))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+    )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if rate_limiter is not None:
+        builder = builder.rate_limiter(rate_limiter)
+    application = builder.build()
+    logger.info("Приложение создано успешно")
+
+    # Обработчики команд
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('start', start),
+            CommandHandler('simulate', simulate_command),
+            CommandHandler('hypothesis', hypothesis_command)
+        ],
+        states={
+            CHOOSING_RESPONDENT: [
+                CallbackQueryHandler(button_handler)
+            ],
+            WAITING_PROFESSION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_profession)
+            ],
+            WAITING_AGE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_age)
+            ],
+            INTERVIEW: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_interview_message)
+            ],
+            HYPOTHESIS_INPUT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_hypothesis)
+            ],
+        },
+        fallbacks=[
+            CommandHandler('start', start),
+            CommandHandler('simulate', simulate_command),
+            CommandHandler('hypothesis', hypothesis_command)
+        ],
+        per_message=False,
+        name='interview',
+        persistent=persistence is not None
+    )
+
+    application.add_handler(TypeHandler(Update, assign_trace_id), group=-1)
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('stats', stats_command))
+    application.add_handler(CommandHandler('usage', usage_command))
+    application.add_handler(CommandHandler('cache', cache_command))
+    application.add_handler(CommandHandler('panel', panel_command))
+    application.add_handler(CommandHandler('analysis', analysis_command))
+    application.add_handler(CommandHandler('compare', compare_command))
+    logger.info("Обработчики команд добавлены")
+
+    # Добавляем обработчик ошибок
+    application.add_error_handler(error_handler)
+    logger.info("Обработчик ошибок добавлен")
+    return application
+
 def main():
     """Запуск бота"""
     try:
         logger.info("Инициализация бота...")
-        
-        # Создаем приложение с расширенными таймаутами
-        application = (
-            Application.builder()
-            .token(os.getenv('TELEGRAM_BOT_TOKEN'))
-            .connect_timeout(30)
-            .read_timeout(30)
-            .write_timeout(30)
-            .get_updates_read_timeout(30)
-            .get_updates_connect_timeout(30)
-            .get_updates_write_timeout(30)
-            .build()
-        )
-        logger.info("Приложение создано успешно")
-
-        # Обработчики команд
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('start', start)],
-            states={
-                CHOOSING_RESPONDENT: [
-                    CallbackQueryHandler(button_handler)
-                ],
-                WAITING_PROFESSION: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_profession)
-                ],
-                WAITING_AGE: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_age)
-                ],
-                INTERVIEW: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_interview_message)
-                ],
-            },
-            fallbacks=[CommandHandler('start', start)],
-            per_message=False
-        )
-
-        application.add_handler(conv_handler)
-        logger.info("Обработчики команд добавлены")
-        
-        # Добавляем обработчик ошибок
-        application.add_error_handler(error_handler)
-        logger.info("Обработчик ошибок добавлен")
+        application = build_application(os.getenv('TELEGRAM_BOT_TOKEN'), persistence=SQLitePersistence(db))
 
         # Запуск бота
         logger.info("Запуск бота...")
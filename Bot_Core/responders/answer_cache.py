@@ -0,0 +1,218 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import numpy as np
+
+from Bot_Core.utils.metrics import ANSWER_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+_PUNCT_RE = re.compile(r'[^\w\s]', re.UNICODE)
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_question(question: str) -> str:
+    """Нормализация вопроса для точного совпадения: регистр, ё, пунктуация, пробелы"""
+    text = question.lower().replace('ё', 'е')
+    text = _PUNCT_RE.sub(' ', text)
+    return _SPACE_RE.sub(' ', text).strip()
+
+
+def within_one_edit(a: str, b: str) -> bool:
+    """Слова отличаются не более чем одной заменой, вставкой или удалением буквы"""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
+
+
+def same_words_up_to_typos(a: str, b: str, min_typo_length: int = 5) -> bool:
+    """Нормализованные вопросы состоят из тех же слов в том же порядке с точностью до опечаток.
+
+    Опечатка допускается только в словах длиннее min_typo_length - 1 букв: короткие слова
+    («не», «НДС»/«УСН») меняют смысл вопроса и должны совпадать точно.
+    """
+    words_a, words_b = a.split(), b.split()
+    if len(words_a) != len(words_b):
+        return False
+    for word_a, word_b in zip(words_a, words_b):
+        if word_a == word_b:
+            continue
+        if min(len(word_a), len(word_b)) < min_typo_length or not within_one_edit(word_a, word_b):
+            return False
+    return True
+
+
+class NgramEmbedder:
+    """Хешированные символьные триграммы: дешево и устойчиво к опечаткам"""
+
+    def __init__(self, dim: int = 2048, n: int = 3):
+        self.dim = dim
+        self.n = n
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        padded = f' {text} '
+        for i in range(len(padded) - self.n + 1):
+            digest = hashlib.blake2b(padded[i:i + self.n].encode('utf-8'), digest_size=4).digest()
+            vector[int.from_bytes(digest, 'little') % self.dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SentenceTransformerEmbedder:
+    """Смысловые эмбеддинги: ловят перефразирование, но дороже триграмм"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+
+    def embed(self, text: str) -> np.ndarray:
+        return self.model.encode(text, normalize_embeddings=True)
+
+
+@dataclass
+class CacheEntry:
+    question: str
+    answer: str
+    vector: Optional[np.ndarray]
+    created_at: float
+
+
+@dataclass
+class CacheHit:
+    answer: str
+    match: str  # exact | similar
+    similarity: float
+    source_question: str
+
+
+class AnswerCache:
+    """Кэш ответов респондента по точному совпадению нормализованного вопроса.
+
+    Нечеткое совпадение включается явно (similarity_threshold): вопрос должен быть
+    ближе порога по косинусной близости и состоять из тех же слов с точностью до
+    опечаток — перефразированный вопрос может иметь другой смысл и кэш не обслуживает.
+
+    Записи живут ttl секунд, на респондента хранится не больше max_per_respondent
+    последних вопросов, а всего — не больше max_respondents респондентов (LRU).
+    Респонденты, у которых истекли все записи, удаляются раз в ttl при записи в кэш.
+    """
+
+    def __init__(self, embedder=None, ttl: float = 3600, max_per_respondent: int = 100,
+                 similarity_threshold: Optional[float] = None, max_respondents: int = 1000):
+        self.similarity_threshold = similarity_threshold
+        self.embedder = (embedder or NgramEmbedder()) if similarity_threshold is not None else None
+        self.ttl = ttl
+        self.max_per_respondent = max_per_respondent
+        self.max_respondents = max_respondents
+        self._entries: Dict[int, OrderedDict] = OrderedDict()
+        self._swept_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'AnswerCache':
+        threshold = os.getenv('ANSWER_CACHE_SIMILARITY', '').strip()
+        similarity_threshold = float(threshold) if threshold else None
+        model_name = os.getenv('ANSWER_CACHE_EMBEDDING_MODEL')
+        embedder = None
+        if model_name and similarity_threshold is not None:
+            try:
+                embedder = SentenceTransformerEmbedder(model_name)
+            except Exception as e:
+                logger.warning(f"Не удалось загрузить {model_name} ({e}), используются триграммы")
+        return cls(
+            embedder=embedder,
+            ttl=float(os.getenv('ANSWER_CACHE_TTL', '3600')),
+            max_per_respondent=int(os.getenv('ANSWER_CACHE_MAX_PER_RESPONDENT', '100')),
+            max_respondents=int(os.getenv('ANSWER_CACHE_MAX_RESPONDENTS', '1000')),
+            similarity_threshold=similarity_threshold,
+        )
+
+    def _live_entries(self, respondent_id: int, now: float) -> Optional[OrderedDict]:
+        """Неистекшие записи респондента; словарь без записей удаляется"""
+        entries = self._entries.get(respondent_id)
+        if entries is None:
+            return None
+        expired = [key for key, entry in entries.items() if now - entry.created_at > self.ttl]
+        for key in expired:
+            del entries[key]
+        if not entries:
+            del self._entries[respondent_id]
+            return None
+        self._entries.move_to_end(respondent_id)
+        return entries
+
+    def _sweep(self, now: float):
+        """Удаление респондентов, у которых истекли все записи (не чаще раза в ttl)"""
+        if now - self._swept_at < self.ttl:
+            return
+        self._swept_at = now
+        for respondent_id in list(self._entries):
+            self._live_entries(respondent_id, now)
+
+    def get(self, respondent_id: int, question: str) -> Optional[CacheHit]:
+        key = normalize_question(question)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._live_entries(respondent_id, now)
+            candidates = []
+            if entries is not None:
+                entry = entries.get(key)
+                if entry is not None:
+                    entries.move_to_end(key)
+                    ANSWER_CACHE_LOOKUPS.inc(result='exact')
+                    return CacheHit(entry.answer, 'exact', 1.0, entry.question)
+                if self.similarity_threshold is not None:
+                    # Дорогое сравнение эмбеддингов — только для вопросов из тех же слов
+                    candidates = [(k, e) for k, e in entries.items() if same_words_up_to_typos(key, k)]
+
+        if candidates:
+            vector = self.embedder.embed(key)
+            matrix = np.stack([entry.vector for _, entry in candidates])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity >= self.similarity_threshold:
+                best_key, entry = candidates[best]
+                with self._lock:
+                    if best_key in entries:
+                        entries.move_to_end(best_key)
+                ANSWER_CACHE_LOOKUPS.inc(result='similar')
+                return CacheHit(entry.answer, 'similar', similarity, entry.question)
+
+        ANSWER_CACHE_LOOKUPS.inc(result='miss')
+        return None
+
+    def put(self, respondent_id: int, question: str, answer: str):
+        key = normalize_question(question)
+        vector = self.embedder.embed(key) if self.embedder is not None else None
+        entry = CacheEntry(question, answer, vector, time.monotonic())
+        with self._lock:
+            entries = self._live_entries(respondent_id, entry.created_at)
+            if entries is None:
+                entries = self._entries[respondent_id] = OrderedDict()
+            entries[key] = entry
+            entries.move_to_end(key)
+            while len(entries) > self.max_per_respondent:
+                entries.popitem(last=False)
+            self._sweep(entry.created_at)
+            while len(self._entries) > self.max_respondents:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, respondent_id: int):
+        with self._lock:
+            self._entries.pop(respondent_id, None)
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import json
 import requests
@@ -5,21 +6,31 @@ import logging
 from dotenv import load_dotenv
 import asyncio
 import re
+import time
+import threading
 import traceback
+from collections import OrderedDict
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()
-    ]
-)
+from Bot_Core.responders import tokens
+from Bot_Core.responders.answer_cache import AnswerCache
+from Bot_Core.responders.tokens import BudgetExceeded, count_message_tokens, count_tokens, usage_context_var
+from Bot_Core.utils.metrics import JSON_PARSE_SECONDS, LLM_REQUEST_SECONDS, LLM_TOKENS, timed
+from Bot_Core.utils.task_queue import run_blocking
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+DEFAULT_MODEL = "deepseek/deepseek-r1-zero:free"
+
+PROFILE_SYSTEM_PROMPT = "Ты - эксперт по созданию реалистичных профилей респондентов для customer development интервью. Твои ответы должны быть в формате JSON."
+
+def get_api_url() -> str:
+    """URL чат-эндпоинта OpenRouter (можно переопределить через OPENROUTER_API_URL)"""
+    return os.getenv('OPENROUTER_API_URL', DEFAULT_API_URL)
+
+@timed(JSON_PARSE_SECONDS)
 def clean_json_text(text: str) -> str:
     """Очистка текста от дополнительного форматирования и извлечение JSON"""
     # Удаляем \boxed{ и другие специальные символы
@@ -68,111 +79,136 @@ def clean_json_text(text: str) -> str:
     
     return text
 
-def generate_llm_response(prompt: str) -> dict:
-    """Генерация ответа через OpenRouter API"""
+def request_completion(messages: list, model: str = DEFAULT_MODEL) -> dict:
+    """Запрос к чат-эндпоинту OpenRouter.
+
+    Возвращает {"content", "usage", "model"} или {"error", "details"}. Перед запросом
+    проверяет бюджет токенов, после — сохраняет фактический расход (см. tokens.py).
+    """
+    context = usage_context_var.get()
+    estimated_tokens = count_message_tokens(messages)
+    if tokens.accountant is not None:
+        tokens.accountant.check(estimated_tokens, context)
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}"
+    }
+    payload = {"model": model, "messages": messages}
+
+    logger.info(f"Отправка запроса к API (~{estimated_tokens} токенов промпта)...")
+    api_url = get_api_url()
+    logger.info(f"URL: {api_url}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Headers: {json.dumps(headers, ensure_ascii=False)}")
+        logger.debug(f"Payload: {json.dumps(payload, ensure_ascii=False)}")
+
+    started = time.perf_counter()
+    status = "exception"
     try:
-        logger.info("Начинаем запрос к OpenRouter API")
-        logger.info(f"Промпт: {prompt}")
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}"
-        }
-        
-        payload = {
-            "model": "deepseek/deepseek-r1-zero:free",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "Ты - эксперт по созданию реалистичных профилей респондентов для customer development интервью. Твои ответы должны быть в формате JSON."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        }
-        
-        logger.info("Отправка запроса к API...")
-        logger.info(f"URL: https://openrouter.ai/api/v1/chat/completions")
-        logger.info(f"Headers: {json.dumps(headers, ensure_ascii=False)}")
-        logger.info(f"Payload: {json.dumps(payload, ensure_ascii=False, indent=2)}")
-        
         response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
+            url=api_url,
             headers=headers,
             json=payload,
             timeout=60
         )
+        status = str(response.status_code)
+    finally:
+        LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, model=model, status=status)
+
+    logger.info(f"Получен ответ от API. Статус: {response.status_code}")
+    logger.debug(f"Заголовки ответа: {dict(response.headers)}")
+    logger.debug(f"Тело ответа: {response.text}")
+
+    if response.status_code != 200:
+        logger.error(f"Ошибка API: {response.status_code}")
+        return {"error": f"Ошибка API: {response.status_code}", "details": response.text}
+
+    result = response.json()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Полный ответ API: {json.dumps(result, ensure_ascii=False)}")
+
+    usage = result.get('usage') or {}
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if usage.get(kind):
+            LLM_TOKENS.inc(usage[kind], model=model, kind=kind.replace('_tokens', ''))
+    if tokens.accountant is not None:
+        tokens.accountant.record(result.get('model') or model, usage, estimated_tokens, context)
+
+    # Пробуем разные варианты получения контента
+    content = None
+    try:
+        if 'choices' in result and len(result['choices']) > 0:
+            message = result['choices'][0].get('message', {})
+            content = message.get('content') or message.get('reasoning')
+        elif 'response' in result:
+            content = result['response']
+    except Exception as e:
+        logger.error(f"Ошибка при извлечении контента: {str(e)}")
+        logger.error(f"Структура ответа: {result}")
+        return {"error": "Ошибка при обработке ответа API", "details": str(e)}
+
+    if not content:
+        logger.error(f"Не удалось найти контент в ответе API: {result}")
+        return {"error": "Неверный формат ответа API", "details": "Отсутствует контент в ответе"}
+
+    logger.debug(f"Извлеченный контент: {content}")
+    return {"content": content, "usage": usage, "model": result.get('model') or model}
+
+def generate_llm_response(prompt: str) -> dict:
+    """Генерация профиля респондента через OpenRouter API"""
+    try:
+        logger.info("Начинаем запрос к OpenRouter API")
+        logger.debug(f"Промпт: {prompt}")
+
+        completion = request_completion([
+            {"role": "system", "content": PROFILE_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ])
+        if "error" in completion:
+            return completion
+
+        # Очищаем текст от форматирования
+        clean_content = clean_json_text(completion["content"])
+        logger.debug(f"Очищенный JSON: {clean_content}")
         
-        logger.info(f"Получен ответ от API. Статус: {response.status_code}")
-        logger.info(f"Заголовки ответа: {dict(response.headers)}")
-        logger.info(f"Тело ответа: {response.text}")
-        
-        if response.status_code == 200:
-            result = response.json()
-            logger.debug(f"Полный ответ API: {json.dumps(result, indent=2, ensure_ascii=False)}")
-            
-            # Пробуем разные варианты получения контента
-            content = None
-            try:
-                if 'choices' in result and len(result['choices']) > 0:
-                    message = result['choices'][0].get('message', {})
-                    content = message.get('content') or message.get('reasoning')
-                elif 'response' in result:
-                    content = result['response']
-                
-                if not content:
-                    logger.error(f"Не удалось найти контент в ответе API: {result}")
-                    return {"error": "Неверный формат ответа API", "details": "Отсутствует контент в ответе"}
-                    
-                logger.debug(f"Извлеченный контент: {content}")
-            except Exception as e:
-                logger.error(f"Ошибка при извлечении контента: {str(e)}")
-                logger.error(f"Структура ответа: {result}")
-                return {"error": "Ошибка при обработке ответа API", "details": str(e)}
+        try:
+            profile_data = json.loads(clean_content)
+            logger.info("JSON успешно обработан")
             
-            # Очищаем текст от форматирования
-            clean_content = clean_json_text(content)
-            logger.debug(f"Очищенный JSON: {clean_content}")
+            # Проверяем наличие всех необходимых полей
+            required_fields = ["name", "age", "profession", "pain_points", "communication_style", "traps"]
+            missing_fields = [field for field in required_fields if field not in profile_data]
             
-            try:
-                profile_data = json.loads(clean_content)
-                logger.info("JSON успешно обработан")
-                
-                # Проверяем наличие всех необходимых полей
-                required_fields = ["name", "age", "profession", "pain_points", "communication_style", "traps"]
-                missing_fields = [field for field in required_fields if field not in profile_data]
-                
-                if missing_fields:
-                    return {
-                        "error": "Неполный профиль",
-                        "details": f"Отсутствуют поля: {', '.join(missing_fields)}",
-                        "raw_content": clean_content
-                    }
-                
-                return profile_data
-                
-            except json.JSONDecodeError as e:
-                logger.error(f"Ошибка при парсинге JSON: {str(e)}")
-                logger.error(f"Проблемный текст: {clean_content}")
+            if missing_fields:
                 return {
-                    "error": "Ошибка при создании профиля",
-                    "details": str(e),
+                    "error": "Неполный профиль",
+                    "details": f"Отсутствуют поля: {', '.join(missing_fields)}",
                     "raw_content": clean_content
                 }
-        else:
-            logger.error(f"Ошибка API: {response.status_code}")
-            return {"error": f"Ошибка API: {response.status_code}", "details": response.text}
             
+            return profile_data
+            
+        except json.JSONDecodeError as e:
+            logger.error(f"Ошибка при парсинге JSON: {str(e)}")
+            logger.error(f"Проблемный текст: {clean_content}")
+            return {
+                "error": "Ошибка при создании профиля",
+                "details": str(e),
+                "raw_content": clean_content
+            }
+
+    except BudgetExceeded as e:
+        logger.warning(str(e))
+        return {"error": "Превышен лимит токенов", "details": str(e)}
     except Exception as e:
         logger.error(f"Неожиданная ошибка: {str(e)}")
         logger.error(traceback.format_exc())
         return {"error": "Неожиданная ошибка", "details": str(e)}
 
-async def generate_responder(age: int, profession: str, trait: str) -> dict:
-    """Генерация профиля респондента"""
-    prompt = f"""
+def build_responder_prompt(age: int, profession: str, trait: str) -> str:
+    """Промпт генерации профиля респондента"""
+    return f"""
     Создай профиль респондента со следующими характеристиками:
     - Возраст: {age} лет
     - Профессия: {profession}
@@ -188,9 +224,14 @@ async def generate_responder(age: int, profession: str, trait: str) -> dict:
         "traps": ["3-4 способа, как респондент уходит от прямых ответов"]
     }}
     """
+
+async def generate_responder(age: int, profession: str, trait: str) -> dict:
+    """Генерация профиля респондента"""
+    prompt = build_responder_prompt(age, profession, trait)
     
     try:
-        response = generate_llm_response(prompt)
+        # requests блокирующий: выполняем в потоке, чтобы не останавливать event loop
+        response = await run_blocking(generate_llm_response, prompt)
         
         if "error" in response:
             logger.error(f"Ошибка при генерации профиля: {response}")
@@ -231,49 +272,121 @@ async def generate_responder(age: int, profession: str, trait: str) -> dict:
             "message": "❌ Произошла непредвиденная ошибка при создании респондента. Попробуйте еще раз."
         }
 
-async def generate_interview_response(question: str, respondent_profile: dict) -> str:
+def build_persona_prompt(respondent_profile: dict) -> str:
+    """Статичная часть промпта интервью: описание персоны респондента"""
+    return f"""Ты - респондент со следующим профилем:
+Имя: {respondent_profile['name']}
+Возраст: {respondent_profile['age']}
+Профессия: {respondent_profile['profession']}
+Стиль общения: {respondent_profile['communication_style']}
+
+Твои болевые точки:
+{chr(10).join('- ' + point for point in respondent_profile['pain_points'])}
+
+Твои паттерны уклонения от прямых ответов:
+{chr(10).join('- ' + trap for trap in respondent_profile['traps'])}
+
+Отвечай на вопросы интервьюера в соответствии со своим профилем, используя указанный стиль общения и случайным образом применяя один из паттернов уклонения. Ответ должен быть реалистичным и отражать твои болевые точки."""
+
+# Начало текста, которым generate_interview_response сообщает об ошибке вместо ответа
+INTERVIEW_ERROR_PREFIX = "Извините, произошла ошибка при генерации ответа"
+
+PERSONA_CACHE_SIZE = int(os.getenv('PERSONA_CACHE_SIZE', '1024'))
+
+# (respondent_id, отпечаток профиля) -> промпт персоны, не больше PERSONA_CACHE_SIZE записей.
+# Отпечаток нужен, потому что id респондента может быть переиспользован после архивации.
+_persona_cache = OrderedDict()
+_persona_lock = threading.Lock()
+
+def profile_fingerprint(respondent_profile: dict) -> str:
+    serialized = json.dumps(respondent_profile, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+def get_persona_prompt(respondent_profile: dict, respondent_id: int = None) -> str:
+    """Промпт персоны, собранный один раз на респондента"""
+    if respondent_id is None:
+        return build_persona_prompt(respondent_profile)
+    key = (respondent_id, profile_fingerprint(respondent_profile))
+    with _persona_lock:
+        persona = _persona_cache.get(key)
+        if persona is not None:
+            _persona_cache.move_to_end(key)
+            return persona
+    persona = build_persona_prompt(respondent_profile)
+    # Прогреваем кэш токенизатора: дальше считается только сам вопрос
+    logger.debug(f"Промпт персоны {respondent_id}: ~{count_tokens(persona)} токенов")
+    with _persona_lock:
+        _persona_cache[key] = persona
+        while len(_persona_cache) > PERSONA_CACHE_SIZE:
+            _persona_cache.popitem(last=False)
+    return persona
+
+def complete_interview_answer(question: str, respondent_profile: dict, respondent_id: int = None) -> str:
+    """Запрос ответа респондента у модели; ошибки API пробрасываются исключением"""
+    messages = [
+        {"role": "system", "content": get_persona_prompt(respondent_profile, respondent_id)},
+        {"role": "user", "content": f"Вопрос: {question}"}
+    ]
+    
+    logger.info(f"Генерация ответа на вопрос: {question}")
+    response = request_completion(messages)
+    if "error" in response:
+        raise RuntimeError(f"{response['error']}: {response.get('details', '')[:200]}")
+    answer = response["content"]
+    
+    # Очищаем ответ от возможных JSON-маркеров и других артефактов
+    clean_answer = re.sub(r'```.*?```', '', answer, flags=re.DOTALL)  # Удаляем код между ```
+    clean_answer = re.sub(r'\{.*?\}', '', clean_answer, flags=re.DOTALL)  # Удаляем JSON
+    clean_answer = clean_answer.strip()
+    
+    logger.info(f"Сгенерирован ответ: {clean_answer}")
+    return clean_answer
+
+async def generate_interview_response(question: str, respondent_profile: dict, respondent_id: int = None) -> str:
     """Генерация ответа на вопрос в интервью с учетом профиля респондента"""
     try:
-        prompt = f"""
-        Ты - респондент со следующим профилем:
-        Имя: {respondent_profile['name']}
-        Возраст: {respondent_profile['age']}
-        Профессия: {respondent_profile['profession']}
-        Стиль общения: {respondent_profile['communication_style']}
-        
-        Твои болевые точки:
-        {chr(10).join('- ' + point for point in respondent_profile['pain_points'])}
-        
-        Твои паттерны уклонения от прямых ответов:
-        {chr(10).join('- ' + trap for trap in respondent_profile['traps'])}
-        
-        Вопрос: {question}
-        
-        Ответь на вопрос в соответствии со своим профилем, используя указанный стиль общения и случайным образом применяя один из паттернов уклонения. Ответ должен быть реалистичным и отражать твои болевые точки.
-        """
-        
-        logger.info(f"Генерация ответа на вопрос: {question}")
-        response = generate_llm_response(prompt)
-        
-        # Извлекаем текст ответа
-        content = response['choices'][0]['message'].get('content', '')
-        reasoning = response['choices'][0]['message'].get('reasoning', '')
-        answer = content if content else reasoning
-        
-        # Очищаем ответ от возможных JSON-маркеров и других артефактов
-        clean_answer = re.sub(r'```.*?```', '', answer, flags=re.DOTALL)  # Удаляем код между ```
-        clean_answer = re.sub(r'\{.*?\}', '', clean_answer, flags=re.DOTALL)  # Удаляем JSON
-        clean_answer = clean_answer.strip()
-        
-        logger.info(f"Сгенерирован ответ: {clean_answer}")
-        return clean_answer
-        
+        return await run_blocking(complete_interview_answer, question, respondent_profile, respondent_id)
+    except BudgetExceeded:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при генерации ответа на вопрос: {str(e)}")
         logger.error(traceback.format_exc())
-        return f"Извините, произошла ошибка при генерации ответа: {str(e)}"
+        return f"{INTERVIEW_ERROR_PREFIX}: {str(e)}"
+
+async def generate_interview_turn(question: str, respondent_profile: dict, respondent_id: int,
+                                  answer_cache: AnswerCache = None) -> dict:
+    """Ответ на вопрос с учетом кэша ответов (если он передан).
+
+    Возвращает {"answer", "cached"} и, для попаданий в кэш, "cache_match",
+    "similarity" и исходный вопрос. Ответы с ошибкой в кэш не попадают.
+    """
+    if answer_cache is not None:
+        hit = answer_cache.get(respondent_id, question)
+        if hit is not None:
+            logger.info(f"Ответ из кэша ({hit.match}, {hit.similarity:.2f}) на вопрос: {question}")
+            return {
+                "answer": hit.answer,
+                "cached": True,
+                "cache_match": hit.match,
+                "similarity": round(hit.similarity, 3),
+                "cached_question": hit.source_question
+            }
+
+    try:
+        answer = await run_blocking(complete_interview_answer, question, respondent_profile, respondent_id)
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при генерации ответа на вопрос: {str(e)}")
+        logger.error(traceback.format_exc())
+        return {"answer": f"{INTERVIEW_ERROR_PREFIX}: {str(e)}", "cached": False}
+
+    if answer_cache is not None and answer:
+        answer_cache.put(respondent_id, question, answer)
+    return {"answer": answer, "cached": False}
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
     # Тестируем сначала простой запрос
     try:
         logger.info("Тестирование API с простым запросом...")
@@ -0,0 +1,187 @@
+import contextvars
+import logging
+import math
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Кто платит за текущий запрос к LLM: выставляется обработчиком, читается в generator
+usage_context_var: contextvars.ContextVar[Optional[Dict]] = contextvars.ContextVar('usage_context', default=None)
+
+# Служебные токены на каждое сообщение чата (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+class BudgetExceeded(Exception):
+    """Запрос превысил бюджет токенов пользователя или интервью"""
+
+    def __init__(self, scope: str, used: int, requested: int, limit: int):
+        self.scope = scope
+        self.used = used
+        self.requested = requested
+        self.limit = limit
+        super().__init__(f"Бюджет токенов ({scope}) исчерпан: {used} + {requested} > {limit}")
+
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    """Токенизатор tiktoken, если установлен; иначе None и используется эвристика"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(os.getenv('TOKENIZER_ENCODING', 'cl100k_base'))
+    except Exception:
+        logger.info("tiktoken недоступен, количество токенов оценивается эвристически")
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """Количество токенов в тексте (кэшируется: статичные части промптов считаются один раз)"""
+    if not text:
+        return 0
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text))
+    # BPE-токенизаторы дробят кириллицу сильнее латиницы: ~3 символа на токен против ~4
+    tokens = 0
+    for word in _WORD_RE.findall(text):
+        chars_per_token = 4 if word.isascii() else 3
+        tokens += max(1, math.ceil(len(word) / chars_per_token))
+    return tokens
+
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    """Оценка размера промпта в формате chat completions"""
+    return sum(count_tokens(m.get('content', '')) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def set_usage_context(user_id: Optional[int] = None, respondent_id: Optional[int] = None,
+                      interview_id: Optional[int] = None):
+    usage_context_var.set({'user_id': user_id, 'respondent_id': respondent_id, 'interview_id': interview_id})
+
+
+def _int_env(name: str) -> int:
+    value = os.getenv(name, '')
+    return int(value) if value else 0
+
+
+class TokenAccountant:
+    """Учет токенов и стоимости по пользователям и интервью с проверкой бюджетов.
+
+    Бюджет 0 означает отсутствие лимита. Суммы подгружаются из БД при первом
+    обращении и дальше ведутся в памяти. Сумма в памяти видит только запросы своего
+    процесса, поэтому она перечитывается из БД (туда пишут все воркеры кластера)
+    раз в max_age секунд и при каждой проверке, когда расход подходит к доле
+    refresh_ratio бюджета.
+    """
+
+    def __init__(self, db, user_budget: int = 0, interview_budget: int = 0,
+                 prompt_price_per_1k: float = 0.0, completion_price_per_1k: float = 0.0,
+                 refresh_ratio: float = 0.8, max_age: float = 5.0):
+        self.db = db
+        self.user_budget = user_budget
+        self.interview_budget = interview_budget
+        self.prompt_price_per_1k = prompt_price_per_1k
+        self.completion_price_per_1k = completion_price_per_1k
+        self.refresh_ratio = refresh_ratio
+        self.max_age = max_age
+        self._user_totals: Dict[int, int] = {}
+        self._interview_totals: Dict[int, int] = {}
+        self._loaded_at: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, db) -> 'TokenAccountant':
+        return cls(
+            db,
+            user_budget=_int_env('USER_TOKEN_BUDGET'),
+            interview_budget=_int_env('INTERVIEW_TOKEN_BUDGET'),
+            prompt_price_per_1k=float(os.getenv('PROMPT_PRICE_PER_1K', '0') or 0),
+            completion_price_per_1k=float(os.getenv('COMPLETION_PRICE_PER_1K', '0') or 0),
+            refresh_ratio=float(os.getenv('TOKEN_BUDGET_REFRESH_RATIO', '0.8') or 0.8),
+            max_age=float(os.getenv('TOKEN_BUDGET_REFRESH_SECONDS', '5') or 5),
+        )
+
+    def _is_stale(self, key: tuple, now: float) -> bool:
+        loaded_at = self._loaded_at.get(key)
+        return loaded_at is None or now - loaded_at > self.max_age
+
+    def user_total(self, user_id: int, refresh: bool = False) -> int:
+        now = time.monotonic()
+        with self._lock:
+            if refresh or self._is_stale(('user', user_id), now):
+                self._user_totals[user_id] = self.db.get_user_token_total(user_id)
+                self._loaded_at[('user', user_id)] = now
+            return self._user_totals[user_id]
+
+    def interview_total(self, interview_id: int, refresh: bool = False) -> int:
+        now = time.monotonic()
+        with self._lock:
+            if refresh or self._is_stale(('interview', interview_id), now):
+                self._interview_totals[interview_id] = self.db.get_interview_token_total(interview_id)
+                self._loaded_at[('interview', interview_id)] = now
+            return self._interview_totals[interview_id]
+
+    def check(self, estimated_tokens: int, context: Optional[Dict] = None):
+        """Проверка бюджетов до отправки запроса; бросает BudgetExceeded"""
+        context = context or {}
+        user_id = context.get('user_id')
+        interview_id = context.get('interview_id')
+        if self.user_budget and user_id is not None:
+            used = self.user_total(user_id)
+            if used + estimated_tokens > self.user_budget * self.refresh_ratio:
+                used = self.user_total(user_id, refresh=True)
+            if used + estimated_tokens > self.user_budget:
+                raise BudgetExceeded('user', used, estimated_tokens, self.user_budget)
+        if self.interview_budget and interview_id is not None:
+            used = self.interview_total(interview_id)
+            if used + estimated_tokens > self.interview_budget * self.refresh_ratio:
+                used = self.interview_total(interview_id, refresh=True)
+            if used + estimated_tokens > self.interview_budget:
+                raise BudgetExceeded('interview', used, estimated_tokens, self.interview_budget)
+
+    def cost(self, usage: Dict) -> float:
+        if usage.get('cost') is not None:
+            return float(usage['cost'])
+        return (usage.get('prompt_tokens', 0) * self.prompt_price_per_1k
+                + usage.get('completion_tokens', 0) * self.completion_price_per_1k) / 1000
+
+    def record(self, model: str, usage: Dict, estimated_prompt_tokens: int, context: Optional[Dict] = None):
+        """Сохранение фактического расхода; при отсутствии usage в ответе используется оценка"""
+        context = context or {}
+        prompt_tokens = int(usage.get('prompt_tokens') or estimated_prompt_tokens)
+        completion_tokens = int(usage.get('completion_tokens') or 0)
+        total_tokens = int(usage.get('total_tokens') or prompt_tokens + completion_tokens)
+        self.db.add_token_usage(
+            user_id=context.get('user_id'),
+            respondent_id=context.get('respondent_id'),
+            interview_id=context.get('interview_id'),
+            model=model,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=total_tokens,
+            estimated_prompt_tokens=estimated_prompt_tokens,
+            cost=self.cost(usage),
+        )
+        with self._lock:
+            if context.get('user_id') in self._user_totals:
+                self._user_totals[context['user_id']] += total_tokens
+            if context.get('interview_id') in self._interview_totals:
+                self._interview_totals[context['interview_id']] += total_tokens
+
+
+# Настраивается при старте бота (configure_accounting); без него учет не ведется
+accountant: Optional[TokenAccountant] = None
+
+
+def configure_accounting(db) -> TokenAccountant:
+    global accountant
+    accountant = TokenAccountant.from_env(db)
+    return accountant
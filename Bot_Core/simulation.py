@@ -0,0 +1,270 @@
+"""Симуляция исследования: LLM-интервьюер проверяет гипотезу на сгенерированных респондентах.
+
+Для каждого респондента создается интервью, интервьюер задает вопросы по одному
+с учетом предыдущих ответов, ответы дает generate_interview_response. Интервью
+идут параллельно (не больше concurrency одновременно), все ходы сохраняются в
+sessions.db под общей записью гипотезы, а итоги сравниваются
+NLPProcessor.compare_interviews с заранее рассчитанными ключевыми словами гипотезы.
+
+    python -m Bot_Core.simulation --hypothesis "Бухгалтеры тратят много времени на ручной ввод" \\
+        --profession бухгалтер --respondents 20 --questions 5 --concurrency 8 --offline
+
+С --offline запросы идут в локальную заглушку модели (benchmarks/fake_openrouter.py).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Bot_Core.responders.generator import (
+    INTERVIEW_ERROR_PREFIX, generate_interview_response, generate_responder, request_completion
+)
+from Bot_Core.responders.tokens import set_usage_context
+from Bot_Core.utils.task_queue import run_blocking
+
+logger = logging.getLogger(__name__)
+
+INTERVIEWER_PROMPT = """Ты - опытный интервьюер, проводящий custdev-интервью.
+Ты проверяешь гипотезу: {hypothesis}
+Твой собеседник: {profession}.
+
+Правила:
+- задавай ровно один открытый вопрос за раз;
+- спрашивай о прошлом опыте и конкретных случаях, а не о мнениях и будущем;
+- не упоминай гипотезу напрямую и не подсказывай ответ;
+- опирайся на предыдущие ответы, уточняй детали и цифры.
+
+Сформулируй следующий вопрос. Ответь только текстом вопроса."""
+
+DEFAULT_TRAITS = ('skeptic', 'chatty')
+
+ProgressCallback = Callable[[int, int, str], Awaitable[None]]
+
+
+def build_interviewer_messages(hypothesis: str, profession: str, transcript: List[Dict]) -> List[Dict]:
+    """Диалог с точки зрения интервьюера: его вопросы — assistant, ответы респондента — user"""
+    messages = [{"role": "system", "content": INTERVIEWER_PROMPT.format(hypothesis=hypothesis, profession=profession)}]
+    if not transcript:
+        messages.append({"role": "user", "content": "Здравствуйте! Я готов ответить на ваши вопросы."})
+    for turn in transcript:
+        messages.append({"role": "assistant", "content": turn["question"]})
+        messages.append({"role": "user", "content": turn["answer"]})
+    return messages
+
+
+def ask_interviewer(hypothesis: str, profession: str, transcript: List[Dict]) -> str:
+    """Следующий вопрос интервьюера; ошибки API пробрасываются исключением"""
+    response = request_completion(build_interviewer_messages(hypothesis, profession, transcript))
+    if "error" in response:
+        raise RuntimeError(f"{response['error']}: {response.get('details', '')[:200]}")
+    question = re.sub(r'^\s*(Вопрос|Интервьюер)\s*:\s*', '', response["content"].strip(), flags=re.IGNORECASE)
+    return question.strip().strip('"«»').strip()
+
+
+class InterviewSimulation:
+    """Параллельное проведение синтетических интервью по одной гипотезе"""
+
+    def __init__(self, db, hypothesis: str, profession: str, hypothesis_id: Optional[int] = None,
+                 respondents: int = 10, questions: int = 5,
+                 concurrency: int = 4, traits=DEFAULT_TRAITS, user_id: Optional[int] = None,
+                 progress: Optional[ProgressCallback] = None, processor_factory: Optional[Callable] = None):
+        self.db = db
+        self.hypothesis = hypothesis
+        self.hypothesis_id = hypothesis_id
+        self.profession = profession
+        self.respondents = respondents
+        self.questions = questions
+        self.concurrency = concurrency
+        self.traits = traits
+        self.user_id = user_id
+        self.progress = progress
+        # В боте NLP-модели уже загружены — передается фабрика, возвращающая общий экземпляр
+        self.processor_factory = processor_factory
+        self._completed = 0
+        self._failed_turns = 0
+
+    async def run(self) -> Dict:
+        if self.hypothesis_id is None:
+            self.hypothesis_id = await run_blocking(
+                lambda: self.db.get_or_create_hypothesis(self.user_id, self.hypothesis).id
+            )
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(index: int):
+            async with semaphore:
+                return await self._interview(index)
+
+        results = await asyncio.gather(*(bounded(i) for i in range(self.respondents)), return_exceptions=True)
+        interviews = [r for r in results if isinstance(r, dict)]
+        errors = [str(r) for r in results if isinstance(r, BaseException)]
+        for error in errors:
+            logger.error(f"Интервью симуляции не состоялось: {error}")
+        elapsed = time.perf_counter() - started
+
+        answers = {i["interview_id"]: [turn["answer"] for turn in i["turns"]] for i in interviews if i["turns"]}
+        insights, insights_error = await self._insights(answers)
+        return {
+            "hypothesis": self.hypothesis,
+            "hypothesis_id": self.hypothesis_id,
+            "profession": self.profession,
+            "interviews": len(interviews),
+            "failed_interviews": len(errors),
+            "turns": sum(len(items) for items in answers.values()),
+            "failed_turns": self._failed_turns,
+            "elapsed_s": round(elapsed, 2),
+            "interviews_per_minute": round(len(interviews) / elapsed * 60, 2) if elapsed else 0.0,
+            "interview_ids": [interview["interview_id"] for interview in interviews],
+            "insights": insights,
+            "insights_error": insights_error,
+        }
+
+    async def _interview(self, index: int) -> Dict:
+        trait = self.traits[index % len(self.traits)]
+        age = 22 + (index * 17) % 45
+        # Каждое интервью — отдельная задача gather со своей копией контекста учета токенов
+        set_usage_context(user_id=self.user_id)
+        result = await generate_responder(age=age, profession=self.profession, trait=trait)
+        if not result['success']:
+            raise RuntimeError(result['message'])
+        profile = result['data']
+        # Запись в базу в потоке: при занятой блокировке SQLite ждет до busy_timeout
+        respondent_id, interview_id = await run_blocking(self._create_interview, profile, trait)
+        set_usage_context(user_id=self.user_id, respondent_id=respondent_id, interview_id=interview_id)
+
+        transcript = []
+        for _ in range(self.questions):
+            question = await run_blocking(ask_interviewer, self.hypothesis, self.profession, transcript)
+            answer = await generate_interview_response(question, profile, respondent_id)
+            if answer.startswith(INTERVIEW_ERROR_PREFIX):
+                self._failed_turns += 1
+                continue
+            turn = {
+                "question": question,
+                "answer": answer,
+                "cached": False,
+                "simulated": True,
+                "timestamp": datetime.now().isoformat()
+            }
+            await run_blocking(self.db.add_response, interview_id, turn)
+            transcript.append(turn)
+
+        self._completed += 1
+        logger.info(f"Симуляция: интервью {interview_id} с {profile['name']} завершено ({len(transcript)} ходов)")
+        if self.progress:
+            await self.progress(self._completed, self.respondents, profile['name'])
+        return {"interview_id": interview_id, "respondent_id": respondent_id, "turns": transcript}
+
+    def _create_interview(self, profile: Dict, trait: str):
+        """Респондент и интервью в базе; возвращает их id"""
+        respondent = self.db.create_respondent(
+            name=profile['name'],
+            age=profile['age'],
+            profession=profile['profession'],
+            trait=trait,
+            profile=profile
+        )
+        interview = self.db.create_interview(
+            respondent_id=respondent.id, hypothesis=self.hypothesis, hypothesis_id=self.hypothesis_id
+        )
+        return respondent.id, interview.id
+
+    async def _insights(self, answers: Dict[int, List[str]]):
+        if not answers:
+            return None, "Нет ответов для анализа"
+        try:
+            from Bot_Core.analytics.nlp_processor import NLPProcessor, ensure_hypothesis_features
+            processor = await run_blocking(self.processor_factory or NLPProcessor)
+            keywords, embedding = await run_blocking(
+                ensure_hypothesis_features, self.db, processor, self.hypothesis_id
+            )
+            return await run_blocking(
+                processor.compare_interviews, answers, self.hypothesis, keywords, embedding
+            ), None
+        except Exception as e:
+            logger.warning(f"Анализ результатов симуляции недоступен: {e}")
+            return None, str(e)
+
+
+def format_report(report: Dict) -> str:
+    lines = [
+        f"Гипотеза: {report['hypothesis']}",
+        f"Профессия респондентов: {report['profession']}",
+        f"Интервью: {report['interviews']} (не удалось: {report['failed_interviews']}), "
+        f"ответов: {report['turns']} (ошибок: {report['failed_turns']})",
+        f"Время: {report['elapsed_s']} с, {report['interviews_per_minute']} интервью/мин",
+    ]
+    insights = report.get('insights')
+    if insights:
+        lines.append(f"Подтверждение гипотезы: {insights['confirmation_rate'] * 100:.0f}%")
+        lines.append(f"Ключевые слова гипотезы: {', '.join(insights['hypothesis_keywords']) or '—'}")
+        if insights.get('similarity') is not None:
+            lines.append(f"Смысловая близость ответов к гипотезе: {insights['similarity']:.2f}")
+        lines += [f"• {insight}" for insight in insights['key_insights']]
+    elif report.get('insights_error'):
+        lines.append(f"Анализ недоступен: {report['insights_error']}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Симуляция custdev-интервью по гипотезе")
+    parser.add_argument('--hypothesis', required=True)
+    parser.add_argument('--profession', required=True)
+    parser.add_argument('--respondents', type=int, default=10)
+    parser.add_argument('--questions', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--db', help="Файл базы (по умолчанию sessions.db, с --offline — временный)")
+    parser.add_argument('--offline', action='store_true', help="Локальная заглушка модели вместо OpenRouter")
+    parser.add_argument('--latency', type=float, default=0.2, help="Задержка заглушки модели, с")
+    parser.add_argument('--json', dest='json_path', help="Сохранить отчет в JSON")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    os.environ.setdefault('LOG_CONSOLE_LEVEL', 'WARNING')
+    from Bot_Core.utils.logging_setup import setup_logging
+    setup_logging()
+
+    stub = None
+    if args.offline:
+        from benchmarks.fake_openrouter import FakeOpenRouter, LatencyModel
+        stub = FakeOpenRouter(latency=LatencyModel(distribution='lognormal', mean=args.latency, spread=0.3))
+        os.environ['OPENROUTER_API_URL'] = stub.start()
+    db_path = args.db or (os.path.join(tempfile.mkdtemp(prefix='custos-sim-'), 'simulation.db')
+                          if args.offline else 'sessions.db')
+
+    from Bot_Core.data.database import DatabaseManager
+    from Bot_Core.responders.tokens import configure_accounting
+    db = DatabaseManager(db_path)
+    configure_accounting(db)
+
+    async def progress(done: int, total: int, name: str):
+        print(f"[{done}/{total}] {name}", flush=True)
+
+    try:
+        simulation = InterviewSimulation(
+            db, args.hypothesis, args.profession, respondents=args.respondents,
+            questions=args.questions, concurrency=args.concurrency, progress=progress
+        )
+        report = asyncio.run(simulation.run())
+    finally:
+        if stub is not None:
+            stub.stop()
+    print(format_report(report))
+    print(f"База: {db_path}")
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import time
+from typing import Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+from Bot_Core.utils.metrics import TELEGRAM_REQUEST_SECONDS
+
+
+class InstrumentedRequest(BaseRequest):
+    """Обертка над транспортом Telegram, замеряющая задержку каждого вызова Bot API"""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         *args, **kwargs) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await self.inner.do_request(url, method, request_data, *args, **kwargs)
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, method=api_method)
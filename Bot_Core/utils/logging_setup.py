@@ -0,0 +1,200 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from Bot_Core.utils.metrics import TraceIdFilter
+
+# Уровни по умолчанию для шумных подсистем; переопределяются через LOG_LEVELS
+DEFAULT_LEVELS = {
+    'httpx': 'WARNING',
+    'httpcore': 'WARNING',
+    'urllib3': 'WARNING',
+    'telegram': 'INFO',
+    'aiohttp.access': 'WARNING',
+}
+
+SECRET_PATTERNS = [
+    re.compile(r'(Bearer\s+)[^\s"\',}]+', re.IGNORECASE),
+    re.compile(r'sk-or-v1-[0-9a-fA-F]{16,}'),
+    re.compile(r'sk-[A-Za-z0-9_\-]{20,}'),
+    re.compile(r'\b\d{6,12}:[A-Za-z0-9_\-]{30,}\b'),  # токен Telegram-бота
+]
+SECRET_ENV_VARS = ('OPENROUTER_API_KEY', 'TELEGRAM_BOT_TOKEN')
+REDACTED = '***'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def redact(text: str, secrets=()) -> str:
+    """Замена ключей API, токенов и Bearer-заголовков на ***"""
+    for secret in secrets:
+        text = text.replace(secret, REDACTED)
+    for pattern in SECRET_PATTERNS:
+        if pattern.groups:
+            text = pattern.sub(lambda m: m.group(1) + REDACTED, text)
+        else:
+            text = pattern.sub(REDACTED, text)
+    return text
+
+
+class RedactingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который маскирует секреты уже после форматирования traceback.
+
+    Стандартный prepare() склеивает сообщение с traceback в record.msg, поэтому
+    фильтр до него не видит текст исключения (там бывают заголовки Bearer). Здесь
+    сообщение и traceback маскируются отдельно, а traceback передается в exc_text —
+    JsonFormatter пишет его в поле exc.
+    """
+
+    def __init__(self, log_queue, max_chars: int = 4000):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+        self.secrets = [v for v in (os.getenv(name) for name in SECRET_ENV_VARS) if v and len(v) >= 8]
+        self._exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        message = redact(record.getMessage(), self.secrets)
+        if len(message) > self.max_chars:
+            message = f"{message[:self.max_chars]}... [обрезано {len(message) - self.max_chars} симв.]"
+        exc_text = record.exc_text
+        if record.exc_info:
+            exc_text = self._exc_formatter.formatException(record.exc_info)
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = redact(exc_text, self.secrets) if exc_text else None
+        if record.stack_info:
+            record.stack_info = redact(record.stack_info, self.secrets)
+        return record
+
+
+class PayloadSamplingFilter(logging.Filter):
+    """Пропускает только долю крупных сообщений (дампы промптов, payload, тел ответов).
+
+    Предупреждения и ошибки не семплируются.
+    """
+
+    def __init__(self, threshold: int = 2000, rate: float = 0.1):
+        super().__init__()
+        self.threshold = threshold
+        self.rate = rate
+        self._random = random.Random()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if len(record.getMessage()) <= self.threshold:
+            return True
+        return self._random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Структурированная запись лога в одну JSON-строку"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'trace_id': getattr(record, 'trace_id', '-'),
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """Разбор строки вида 'Bot_Core.responders=DEBUG,httpx=WARNING'"""
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def build_file_handler(path: str) -> logging.Handler:
+    """Файловый обработчик с ротацией по размеру или, если задан LOG_ROTATE_WHEN, по времени"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    backup_count = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+    when = os.getenv('LOG_ROTATE_WHEN')
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(
+            path, when=when, backupCount=backup_count, encoding='utf-8', delay=True)
+    return logging.handlers.RotatingFileHandler(
+        path, maxBytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+        backupCount=backup_count, encoding='utf-8', delay=True)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Неблокирующая настройка логирования.
+
+    Корневой логгер пишет в очередь, а форматирование JSON и запись на диск
+    выполняет отдельный поток QueueListener, так что event loop не ждет диск.
+    Повторный вызов возвращает уже запущенный listener.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    log_file = os.getenv('LOG_FILE', os.path.join('logs', 'bot.log'))
+    file_handler = build_file_handler(log_file)
+    file_handler.setFormatter(JsonFormatter())
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(os.getenv('LOG_CONSOLE_LEVEL', 'INFO').upper())
+    console_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = RedactingQueueHandler(
+        log_queue, max_chars=int(os.getenv('LOG_MAX_MESSAGE_CHARS', '4000')))
+    # Фильтры выполняются в вызывающем потоке: там доступен trace_id из contextvars
+    queue_handler.addFilter(TraceIdFilter())
+    queue_handler.addFilter(PayloadSamplingFilter(
+        threshold=int(os.getenv('LOG_PAYLOAD_THRESHOLD', '2000')),
+        rate=float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.1')),
+    ))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    levels = dict(DEFAULT_LEVELS)
+    levels.update(parse_levels(os.getenv('LOG_LEVELS', '')))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    logging.getLogger(__name__).info(f"Логирование настроено, файл: {log_file}")
+    return _listener
+
+
+def shutdown_logging():
+    """Остановка фонового потока с дозаписью оставшихся сообщений"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
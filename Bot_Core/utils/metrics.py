@@ -0,0 +1,261 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор трассировки текущего апдейта; наследуется дочерними задачами asyncio
+trace_id_var: contextvars.ContextVar[str] = contextvars.ContextVar('trace_id', default='-')
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def new_trace_id() -> str:
+    """Генерация и установка нового trace_id в текущем контексте"""
+    trace_id = uuid.uuid4().hex[:16]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+
+class TraceIdFilter(logging.Filter):
+    """Добавляет trace_id текущего апдейта в каждую запись лога"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Optional[Dict[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in items]
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": le})} {cumulative}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {count}')
+        return lines
+
+    def quantile(self, q: float, counts: List[int]) -> float:
+        """Оценка квантиля по корзинам (верхняя граница корзины)"""
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound if bound != float('inf') else self.buckets[-1]
+        return self.buckets[-1]
+
+    def summary(self) -> List[Dict]:
+        with self._lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        result = []
+        for key, counts, total, count in items:
+            result.append({
+                'labels': dict(zip(self.labelnames, key)),
+                'count': count,
+                'avg': total / count if count else 0.0,
+                'p50': self.quantile(0.5, counts),
+                'p95': self.quantile(0.95, counts),
+            })
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def metrics(self) -> List[_Metric]:
+        return list(self._metrics.values())
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+LLM_REQUEST_SECONDS = REGISTRY.histogram(
+    'custos_llm_request_seconds', 'Длительность запроса к LLM', ('model', 'status'))
+LLM_TOKENS = REGISTRY.counter(
+    'custos_llm_tokens_total', 'Количество токенов по данным API', ('model', 'kind'))
+JSON_PARSE_SECONDS = REGISTRY.histogram(
+    'custos_json_parse_seconds', 'Время разбора JSON в clean_json_text',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+DB_OPERATION_SECONDS = REGISTRY.histogram(
+    'custos_db_operation_seconds', 'Время операций DatabaseManager', ('operation',))
+NLP_INFERENCE_SECONDS = REGISTRY.histogram(
+    'custos_nlp_inference_seconds', 'Время инференса NLP-моделей', ('operation',))
+TELEGRAM_REQUEST_SECONDS = REGISTRY.histogram(
+    'custos_telegram_request_seconds', 'Задержка вызовов Telegram Bot API', ('method',))
+ANSWER_CACHE_LOOKUPS = REGISTRY.counter(
+    'custos_answer_cache_lookups_total', 'Обращения к кэшу ответов респондентов', ('result',))
+UPDATES_TOTAL = REGISTRY.counter(
+    'custos_updates_total', 'Количество обработанных апдейтов', ('kind',))
+OUTBOX_MESSAGES = REGISTRY.counter(
+    'custos_outbox_messages_total', 'Исходящие сообщения Telegram по результату', ('status',))
+OUTBOX_DELAY_SECONDS = REGISTRY.histogram(
+    'custos_outbox_delay_seconds', 'Время ожидания сообщения в очереди отправки')
+JOB_RUN_SECONDS = REGISTRY.histogram(
+    'custos_job_run_seconds', 'Время выполнения фоновых задач', ('kind',),
+    buckets=DEFAULT_BUCKETS + (120.0, 300.0, 600.0))
+JOBS_TOTAL = REGISTRY.counter(
+    'custos_jobs_total', 'Фоновые задачи по итогам выполнения', ('kind', 'status'))
+
+
+def timed(histogram: Histogram, **labels):
+    """Декоратор замера времени для синхронных и асинхронных функций"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_stats(registry: MetricsRegistry = REGISTRY) -> str:
+    """Краткая сводка метрик для команды /stats"""
+    lines = []
+    for metric in registry.metrics():
+        if isinstance(metric, Histogram):
+            for item in metric.summary():
+                labels = ', '.join(f'{k}={v}' for k, v in item['labels'].items() if v)
+                title = f"{metric.name.replace('custos_', '')}" + (f" ({labels})" if labels else '')
+                lines.append(
+                    f"• {title}: n={item['count']}, avg={item['avg'] * 1000:.1f} мс, "
+                    f"p50≤{item['p50'] * 1000:.0f} мс, p95≤{item['p95'] * 1000:.0f} мс"
+                )
+        elif isinstance(metric, Counter):
+            for key, value in metric.snapshot().items():
+                labels = ', '.join(f'{k}={v}' for k, v in zip(metric.labelnames, key) if v)
+                title = f"{metric.name.replace('custos_', '')}" + (f" ({labels})" if labels else '')
+                lines.append(f"• {title}: {value:g}")
+    return '\n'.join(lines) if lines else 'Метрик пока нет'
+
+
+async def start_metrics_server(host: str = '127.0.0.1', port: int = 9108,
+                               registry: MetricsRegistry = REGISTRY):
+    """Запуск HTTP-эндпоинта /metrics в текущем event loop, возвращает AppRunner"""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
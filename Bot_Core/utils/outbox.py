@@ -0,0 +1,279 @@
+"""Исходящие сообщения Telegram: ограничение частоты и неблокирующая отправка.
+
+FloodControlLimiter подключается к Application как rate limiter и ограничивает
+все вызовы Bot API, адресованные чату: глобально (~30 сообщений/с) и для
+каждого чата (личные ~1/с, группы ~20/мин), а при RetryAfter ждет и повторяет.
+
+Outbox — очередь отправки для обработчиков: сообщения одного чата уходят по
+порядку, обработчик не ждет доставки, сетевые ошибки повторяются в фоне.
+Статусное сообщение ("Думаю над ответом...") затем редактируется в ответ,
+а если еще не было отправлено — просто заменяется им.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.ext import BaseRateLimiter
+
+from Bot_Core.utils.metrics import OUTBOX_DELAY_SECONDS, OUTBOX_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Разбивка длинного текста по абзацам, строкам или пробелам"""
+    chunks = []
+    while len(text) > limit:
+        cut = -1
+        for separator in ('\n\n', '\n', ' '):
+            cut = text.rfind(separator, 0, limit)
+            if cut > limit // 2:
+                break
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше burst подряд"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+
+class FloodControlLimiter(BaseRateLimiter):
+    """Ограничение частоты вызовов Bot API по лимитам Telegram с повтором при RetryAfter"""
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate_per_minute: float = 20, max_retries: int = 5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._paused_until = 0.0
+
+    @classmethod
+    def from_env(cls) -> 'FloodControlLimiter':
+        return cls(
+            global_rate=float(os.getenv('TG_GLOBAL_RATE', '30')),
+            chat_rate=float(os.getenv('TG_CHAT_RATE', '1')),
+            group_rate_per_minute=float(os.getenv('TG_GROUP_RATE_PER_MINUTE', '20')),
+        )
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Забываем чаты, чьи лимиты уже полностью восстановились
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle()}
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            bucket = TokenBucket(self.group_rate, self.chat_burst) if is_group else TokenBucket(
+                self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback: Callable[..., Coroutine[Any, Any, Any]], args, kwargs,
+                              endpoint: str, data: Dict[str, Any], rate_limit_args: Optional[int]):
+        chat_id = data.get('chat_id')
+        for attempt in range(self.max_retries + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = _retry_seconds(e)
+                OUTBOX_MESSAGES.inc(status='flood_wait')
+                logger.warning(f"Flood control в {endpoint} (чат {chat_id}): пауза {retry_after} с")
+                # Пока действует ограничение, остальные запросы тоже ждут
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+
+class StatusMessage:
+    """Статусное сообщение, которое затем превращается в ответ"""
+
+    def __init__(self, outbox: 'Outbox', item: '_Outgoing'):
+        self.outbox = outbox
+        self.item = item
+
+    def resolve(self, text: str, **kwargs) -> asyncio.Future:
+        """Заменить статус ответом; длинный ответ дописывается отдельными сообщениями"""
+        chunks = split_message(text)
+        first, rest = chunks[0], chunks[1:]
+        first_kwargs = {} if rest else kwargs
+        item = self.item
+        if item.state == 'queued':
+            # Статус еще не отправлен: отправляем сразу ответ
+            item.text, item.kwargs = first, first_kwargs
+            OUTBOX_MESSAGES.inc(status='coalesced')
+            future = item.future
+        else:
+            future = self.outbox._enqueue(
+                _Outgoing(item.bot, item.chat_id, 'edit', first, first_kwargs, status=item)
+            )
+        for index, chunk in enumerate(rest):
+            future = self.outbox._enqueue(
+                _Outgoing(item.bot, item.chat_id, 'send', chunk, kwargs if index == len(rest) - 1 else {})
+            )
+        return future
+
+
+class _Outgoing:
+    def __init__(self, bot, chat_id, action: str, text: str, kwargs: dict, status: '_Outgoing' = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.action = action        # send | edit
+        self.text = text
+        self.kwargs = kwargs
+        self.status = status        # для edit: статусное сообщение, которое редактируется
+        self.state = 'queued'       # queued | sending | sent | failed
+        self.message = None
+        self.created = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class Outbox:
+    """Очередь исходящих сообщений: порядок внутри чата, повторы в фоне"""
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self._queues: Dict[Any, Deque[_Outgoing]] = {}
+        self._workers: Dict[Any, asyncio.Task] = {}
+
+    def send(self, bot, chat_id, text: str, **kwargs) -> asyncio.Future:
+        """Поставить сообщение в очередь; длинный текст разбивается на части"""
+        chunks = split_message(text)
+        future = None
+        for index, chunk in enumerate(chunks):
+            # Клавиатура и прочие параметры — у последней части
+            future = self._enqueue(_Outgoing(bot, chat_id, 'send', chunk, kwargs if index == len(chunks) - 1 else {}))
+        return future
+
+    def status(self, bot, chat_id, text: str) -> StatusMessage:
+        item = _Outgoing(bot, chat_id, 'send', text, {})
+        self._enqueue(item)
+        return StatusMessage(self, item)
+
+    def _enqueue(self, item: _Outgoing) -> asyncio.Future:
+        self._queues.setdefault(item.chat_id, deque()).append(item)
+        worker = self._workers.get(item.chat_id)
+        if worker is None or worker.done():
+            self._workers[item.chat_id] = asyncio.create_task(self._drain_chat(item.chat_id))
+        return item.future
+
+    async def _drain_chat(self, chat_id):
+        queue = self._queues[chat_id]
+        while queue:
+            item = queue[0]
+            await self._deliver(item)
+            queue.popleft()
+        self._queues.pop(chat_id, None)
+        self._workers.pop(chat_id, None)
+
+    async def _call(self, item: _Outgoing):
+        if item.action == 'edit':
+            status = item.status
+            if status.state != 'sent':
+                # Статус так и не дошел — отправляем ответ новым сообщением
+                return await item.bot.send_message(item.chat_id, item.text, **item.kwargs)
+            try:
+                return await item.bot.edit_message_text(
+                    item.text, chat_id=item.chat_id, message_id=status.message.message_id, **item.kwargs
+                )
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    return status.message
+                raise
+        return await item.bot.send_message(item.chat_id, item.text, **item.kwargs)
+
+    async def _deliver(self, item: _Outgoing):
+        item.state = 'sending'
+        OUTBOX_DELAY_SECONDS.observe(time.monotonic() - item.created)
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                item.message = await self._call(item)
+                item.state = 'sent'
+                OUTBOX_MESSAGES.inc(status='sent')
+                if not item.future.done():
+                    item.future.set_result(item.message)
+                return
+            except RetryAfter as e:
+                # Сюда попадаем, только если лимитер не подключен или исчерпал повторы
+                if attempt == self.max_attempts:
+                    error = e
+                    break
+                await asyncio.sleep(_retry_seconds(e))
+            except (TimedOut, NetworkError) as e:
+                if isinstance(e, BadRequest) or attempt == self.max_attempts:
+                    error = e
+                    break
+                delay = self.base_delay * 2 ** (attempt - 1)
+                OUTBOX_MESSAGES.inc(status='retried')
+                logger.warning(f"Не удалось отправить сообщение в чат {item.chat_id} ({e}), повтор через {delay} с")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                error = e
+                break
+        item.state = 'failed'
+        OUTBOX_MESSAGES.inc(status='failed')
+        if isinstance(error, Forbidden):
+            logger.info(f"Чат {item.chat_id} недоступен (бот заблокирован?): {error}")
+        else:
+            logger.error(f"Сообщение в чат {item.chat_id} не доставлено: {error}")
+        if not item.future.done():
+            item.future.set_exception(error)
+            # Обработчики обычно не ждут доставки — не засоряем лог "exception was never retrieved"
+            item.future.exception()
+
+    async def drain(self, timeout: float = 30):
+        """Дождаться отправки всех сообщений (при остановке бота)"""
+        workers = [w for w in self._workers.values() if not w.done()]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
@@ -0,0 +1,362 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import or_, update
+from sqlalchemy.orm import sessionmaker
+
+from Bot_Core.data.database import BackgroundJob
+from Bot_Core.utils.metrics import JOB_RUN_SECONDS, JOBS_TOTAL
+
+logger = logging.getLogger(__name__)
+
+# Классы задач в порядке важности: у каждого свой пул воркеров и свой пул потоков,
+# поэтому пакетная работа не занимает слоты другого класса и потоки, в которых
+# выполняются ответы в интервью. Внутри класса — сортировка по priority.
+JOB_CLASSES = {
+    'generation': 10,   # генерация респондентов, панелей и симуляции
+    'analytics': 20,    # анализ, отчеты, архивация
+}
+DEFAULT_POOLS = {'generation': 2, 'analytics': 1}
+
+# Пул потоков класса задачи, которая выполняется в текущем контексте (None — вне задач)
+job_executor_var: contextvars.ContextVar[Optional[ThreadPoolExecutor]] = contextvars.ContextVar(
+    'job_executor', default=None)
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+JobHandler = Callable[[dict, 'JobContext'], Awaitable[object]]
+Subscriber = Callable[[dict], Awaitable[None]]
+
+
+class PermanentJobError(Exception):
+    """Ошибка, при которой повторять задачу бессмысленно"""
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Аналог asyncio.to_thread: внутри фоновой задачи вызов идет в пул потоков ее класса,
+    в обработчиках Telegram — в пул потоков event loop по умолчанию"""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(job_executor_var.get(), call)
+
+
+def job_snapshot(job: BackgroundJob) -> dict:
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'job_class': job.job_class,
+        'status': job.status,
+        'attempts': job.attempts,
+        'progress': job.progress or 0.0,
+        'progress_message': job.progress_message,
+        'result': job.result,
+        'error': job.error,
+        'payload': job.payload,
+    }
+
+
+class JobContext:
+    """Передается обработчику задачи для отчета о прогрессе"""
+
+    def __init__(self, queue: 'TaskQueue', job_id: int, attempt: int):
+        self.queue = queue
+        self.job_id = job_id
+        self.attempt = attempt
+
+    async def progress(self, fraction: float, message: str = None):
+        await self.queue.set_progress(self.job_id, fraction, message)
+
+
+class TaskQueue:
+    """Очередь фоновых задач в SQLite с приоритетами, повторами и дедупликацией.
+
+    Задача захватывается воркером на время lease; если процесс упал, по истечении
+    lease задача снова становится доступной, поэтому задачи переживают перезапуск.
+    Каждый класс задач обслуживается своим пулом asyncio-воркеров и своим пулом
+    потоков: блокирующую работу обработчики выносят в поток через run_blocking.
+    Обращения очереди к SQLite тоже выполняются в потоке, не занимая event loop.
+    """
+
+    def __init__(self, engine, pools: Optional[Dict[str, int]] = None, poll_interval: float = 1.0,
+                 lease_seconds: float = 600, worker_id: str = None, threads_per_worker: int = 4):
+        self.Session = sessionmaker(bind=engine, expire_on_commit=False)
+        self.pools = {}
+        for job_class, size in (pools or DEFAULT_POOLS).items():
+            if job_class in JOB_CLASSES:
+                self.pools[job_class] = size
+            else:
+                logger.warning(f"Пул для неизвестного класса задач {job_class} пропущен")
+        self.threads_per_worker = threads_per_worker
+        self.executors: Dict[str, ThreadPoolExecutor] = {}
+        self.poll_interval = poll_interval
+        self.lease = timedelta(seconds=lease_seconds)
+        self.worker_id = worker_id or f'pid{os.getpid()}'
+        self.handlers: Dict[str, tuple] = {}
+        self._subscribers: Dict[int, List[Subscriber]] = {}
+        self._listeners: List[Subscriber] = []
+        self._wakeups: Dict[str, asyncio.Event] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._running = False
+
+    @classmethod
+    def pools_from_env(cls) -> Dict[str, int]:
+        """JOB_POOLS=generation=2,analytics=1"""
+        pools = dict(DEFAULT_POOLS)
+        for item in os.getenv('JOB_POOLS', '').split(','):
+            if '=' in item:
+                name, size = item.split('=', 1)
+                pools[name.strip()] = int(size)
+        return pools
+
+    def register(self, kind: str, handler: JobHandler, job_class: str = 'analytics', max_attempts: int = 3):
+        if job_class not in JOB_CLASSES:
+            raise ValueError(f"Неизвестный класс задач: {job_class}")
+        self.handlers[kind] = (handler, job_class, max_attempts)
+
+    @staticmethod
+    def default_dedup_key(kind: str, payload: dict) -> str:
+        digest = hashlib.sha1(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+        return f'{kind}:{digest}'
+
+    async def enqueue(self, kind: str, payload: dict, priority: int = None, dedup_key: str = None) -> dict:
+        """Постановка задачи; идентичная незавершенная задача не дублируется"""
+        snapshot = await asyncio.to_thread(self._insert, kind, payload, priority, dedup_key)
+        wakeup = self._wakeups.get(snapshot['job_class'])
+        if wakeup and not snapshot.get('duplicate'):
+            wakeup.set()
+        return snapshot
+
+    def _insert(self, kind: str, payload: dict, priority: int = None, dedup_key: str = None) -> dict:
+        handler, job_class, max_attempts = self.handlers[kind]
+        dedup_key = dedup_key or self.default_dedup_key(kind, payload)
+        with self.Session() as session:
+            existing = (
+                session.query(BackgroundJob)
+                .filter(BackgroundJob.dedup_key == dedup_key, BackgroundJob.status.in_(ACTIVE_STATUSES))
+                .first()
+            )
+            if existing:
+                logger.info(f"Задача {kind} уже в очереди (#{existing.id}), дубликат не создан")
+                return {**job_snapshot(existing), 'duplicate': True}
+            job = BackgroundJob(
+                kind=kind,
+                job_class=job_class,
+                priority=JOB_CLASSES[job_class] if priority is None else priority,
+                payload=payload,
+                dedup_key=dedup_key,
+                max_attempts=max_attempts,
+            )
+            session.add(job)
+            session.commit()
+            JOBS_TOTAL.inc(kind=kind, status='enqueued')
+            logger.info(f"Задача {kind} #{job.id} поставлена в очередь ({job_class})")
+            return job_snapshot(job)
+
+    def get_job(self, job_id: int) -> Optional[dict]:
+        with self.Session() as session:
+            job = session.get(BackgroundJob, job_id)
+            return job_snapshot(job) if job else None
+
+    def subscribe(self, job_id: int, callback: Subscriber):
+        """Подписка на изменения задачи (прогресс, завершение) в текущем процессе"""
+        self._subscribers.setdefault(job_id, []).append(callback)
+
+    def add_listener(self, callback: Subscriber):
+        """Подписка на изменения всех задач, в том числе поставленных до перезапуска"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Subscriber):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    async def _notify(self, snapshot: dict):
+        for callback in self._listeners + list(self._subscribers.get(snapshot['id'], [])):
+            try:
+                await callback(snapshot)
+            except Exception as e:
+                logger.warning(f"Ошибка подписчика задачи #{snapshot['id']}: {e}")
+        if snapshot['status'] in ('done', 'failed'):
+            self._subscribers.pop(snapshot['id'], None)
+
+    async def set_progress(self, job_id: int, fraction: float, message: str = None):
+        await self._notify(await asyncio.to_thread(self._store_progress, job_id, fraction, message))
+
+    def _store_progress(self, job_id: int, fraction: float, message: str = None) -> dict:
+        with self.Session() as session:
+            job = session.get(BackgroundJob, job_id)
+            job.progress = max(0.0, min(1.0, fraction))
+            job.progress_message = message
+            job.lease_until = datetime.utcnow() + self.lease
+            session.commit()
+            return job_snapshot(job)
+
+    def _claim(self, job_class: str) -> Optional[BackgroundJob]:
+        """Атомарный захват самой приоритетной доступной задачи класса"""
+        now = datetime.utcnow()
+        with self.Session() as session:
+            candidates = (
+                session.query(BackgroundJob.id)
+                .filter(
+                    BackgroundJob.job_class == job_class,
+                    BackgroundJob.kind.in_(list(self.handlers)),
+                    or_(
+                        (BackgroundJob.status == 'pending') & (BackgroundJob.run_after <= now),
+                        (BackgroundJob.status == 'running') & (BackgroundJob.lease_until < now),
+                    ),
+                )
+                .order_by(BackgroundJob.priority, BackgroundJob.id)
+                .limit(5)
+                .all()
+            )
+            for (job_id,) in candidates:
+                claimed = session.execute(
+                    update(BackgroundJob)
+                    .where(
+                        BackgroundJob.id == job_id,
+                        or_(
+                            BackgroundJob.status == 'pending',
+                            (BackgroundJob.status == 'running') & (BackgroundJob.lease_until < now),
+                        ),
+                    )
+                    .values(
+                        status='running',
+                        attempts=BackgroundJob.attempts + 1,
+                        lease_until=now + self.lease,
+                        worker=self.worker_id,
+                        updated_at=now,
+                    )
+                )
+                session.commit()
+                if claimed.rowcount == 1:
+                    return session.get(BackgroundJob, job_id)
+        return None
+
+    async def _run_job(self, job: BackgroundJob):
+        handler, _, _ = self.handlers[job.kind]
+        context = JobContext(self, job.id, job.attempts)
+        logger.info(f"Выполнение задачи {job.kind} #{job.id}, попытка {job.attempts}")
+        status = 'failed'
+        with JOB_RUN_SECONDS.time(kind=job.kind):
+            try:
+                result = await handler(job.payload or {}, context)
+                values = {'status': 'done', 'result': result, 'progress': 1.0, 'error': None}
+                status = 'done'
+            except Exception as e:
+                logger.error(f"Задача {job.kind} #{job.id} завершилась ошибкой: {e}")
+                logger.debug(traceback.format_exc())
+                if job.attempts < job.max_attempts and not isinstance(e, PermanentJobError):
+                    status = 'retry'
+                    values = {
+                        'status': 'pending',
+                        'error': str(e),
+                        'run_after': datetime.utcnow() + timedelta(seconds=2 ** job.attempts),
+                    }
+                else:
+                    values = {'status': 'failed', 'error': str(e)}
+        JOBS_TOTAL.inc(kind=job.kind, status=status)
+        snapshot = await asyncio.to_thread(self._finish, job.id, values)
+        if status == 'retry':
+            self._wakeups[job.job_class].set()
+        await self._notify(snapshot)
+
+    def _finish(self, job_id: int, values: dict) -> dict:
+        with self.Session() as session:
+            stored = session.get(BackgroundJob, job_id)
+            for key, value in values.items():
+                setattr(stored, key, value)
+            stored.lease_until = None
+            session.commit()
+            return job_snapshot(stored)
+
+    async def _worker(self, job_class: str):
+        wakeup = self._wakeups[job_class]
+        # Воркер — отдельная asyncio-задача со своим контекстом: блокирующие вызовы
+        # выполняемых им задач (run_blocking) идут в пул потоков его класса
+        job_executor_var.set(self.executors[job_class])
+        while self._running:
+            try:
+                job = await asyncio.to_thread(self._claim, job_class)
+            except Exception as e:
+                logger.error(f"Ошибка захвата задачи ({job_class}): {e}")
+                job = None
+            if job is None:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run_job(job)
+
+    def start(self):
+        """Запуск пулов воркеров в текущем event loop"""
+        if self._running:
+            return
+        self._running = True
+        self.recover_orphans()
+        for job_class, size in self.pools.items():
+            self._wakeups[job_class] = asyncio.Event()
+            self.executors[job_class] = ThreadPoolExecutor(
+                max_workers=max(1, size * self.threads_per_worker), thread_name_prefix=f'jobs-{job_class}')
+            for _ in range(size):
+                self._tasks.append(asyncio.create_task(self._worker(job_class)))
+        logger.info(f"Очередь задач запущена: {self.pools}")
+
+    async def stop(self):
+        """Остановка воркеров; прерванные задачи сразу возвращаются в очередь"""
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
+        self.executors.clear()
+        await asyncio.to_thread(self._release_own)
+
+    @staticmethod
+    def _process_alive(worker: str) -> bool:
+        if not worker or not worker.startswith('pid'):
+            return True
+        try:
+            os.kill(int(worker[3:]), 0)
+        except ProcessLookupError:
+            return False
+        except (ValueError, PermissionError):
+            return True
+        return True
+
+    def recover_orphans(self) -> int:
+        """Возврат в очередь задач, чей процесс завершился аварийно, не дожидаясь lease"""
+        with self.Session() as session:
+            orphans = [
+                job for job in session.query(BackgroundJob).filter(BackgroundJob.status == 'running')
+                # Свой worker_id при старте означает прошлый процесс с тем же pid (например, в контейнере)
+                if job.worker == self.worker_id or not self._process_alive(job.worker)
+            ]
+            for job in orphans:
+                job.status = 'pending'
+                job.lease_until = None
+            session.commit()
+        if orphans:
+            logger.warning(f"Возвращено в очередь задач после аварийного завершения: {len(orphans)}")
+        return len(orphans)
+
+    def _release_own(self):
+        """Возврат в очередь задач, прерванных остановкой этого процесса"""
+        with self.Session() as session:
+            session.query(BackgroundJob).filter(
+                BackgroundJob.status == 'running',
+                BackgroundJob.worker == self.worker_id,
+            ).update({'status': 'pending', 'lease_until': None, 'attempts': BackgroundJob.attempts - 1},
+                     synchronize_session=False)
+            session.commit()
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+FAKE_NAMES = ["Олег Петров", "Анна Смирнова", "Игорь Васильев", "Мария Кузнецова", "Денис Орлов"]
+
+FAKE_ANSWERS = [
+    "Ну, знаете, мы всё делаем по старинке, в Excel. Автоматизация — это дорого, а вы сами пробовали?",
+    "Честно говоря, больше всего времени уходит на ручную сверку. Хотя, может, это и не проблема.",
+    "Сложно сказать. В прошлом году пробовали новый сервис, но потом вернулись к бумажкам.",
+]
+
+FAKE_QUESTIONS = [
+    "Расскажите, как вы в последний раз закрывали месяц?",
+    "Что в этом процессе заняло больше всего времени?",
+    "Как вы решаете эту задачу сейчас и сколько это стоит?",
+    "Пробовали ли вы что-то изменить? Что из этого вышло?",
+]
+
+# Фраза из промпта интервьюера (Bot_Core/simulation.py): на такие запросы отвечаем вопросом
+INTERVIEWER_MARKER = "Сформулируй следующий вопрос"
+
+
+@dataclass
+class LatencyModel:
+    """Распределение задержки ответа модели (в секундах)"""
+    distribution: str = "constant"  # constant | uniform | lognormal
+    mean: float = 0.1
+    spread: float = 0.0
+
+    def sample(self, rng: random.Random) -> float:
+        if self.distribution == "uniform":
+            return max(0.0, rng.uniform(self.mean - self.spread, self.mean + self.spread))
+        if self.distribution == "lognormal":
+            # spread трактуется как sigma логнормального распределения, mean — как медиана
+            return self.mean * rng.lognormvariate(0.0, self.spread or 0.5)
+        return self.mean
+
+
+@dataclass
+class FakeOpenRouterStats:
+    requests: int = 0
+    errors: int = 0
+    streamed: int = 0
+    by_status: Dict[int, int] = field(default_factory=dict)
+
+
+class FakeOpenRouter:
+    """Локальный сервер, имитирующий /api/v1/chat/completions OpenRouter.
+
+    Сервер работает в отдельном потоке со своим event loop, поэтому
+    синхронные клиенты (requests) в основном цикле не приводят к дедлоку.
+    """
+
+    def __init__(self, latency: Optional[LatencyModel] = None, error_rate: float = 0.0,
+                 error_statuses=(429, 500, 502), stream_chunk_delay: float = 0.01,
+                 seed: int = 42, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency or LatencyModel()
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.stream_chunk_delay = stream_chunk_delay
+        self.host = host
+        self.port = port
+        self.stats = FakeOpenRouterStats()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/api/v1/chat/completions"
+
+    def start(self) -> str:
+        """Запуск сервера в фоновом потоке, возвращает URL эндпоинта"""
+        self._thread = threading.Thread(target=self._serve, name="fake-openrouter", daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout=10)
+        logger.info(f"Fake OpenRouter слушает {self.url}")
+        return self.url
+
+    def stop(self):
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop)
+        future.result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=10)
+        self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_post("/api/v1/chat/completions", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+        # При port=0 ОС выбирает свободный порт
+        self.port = self._runner.addresses[0][1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    def _draw(self):
+        with self._lock:
+            delay = self.latency.sample(self._rng)
+            failed = self._rng.random() < self.error_rate
+            status = self._rng.choice(self.error_statuses) if failed else 200
+            name = self._rng.choice(FAKE_NAMES)
+            answer = self._rng.choice(FAKE_ANSWERS)
+            question = self._rng.choice(FAKE_QUESTIONS)
+        return delay, status, name, answer, question
+
+    def _record(self, status: int, streamed: bool = False):
+        with self._lock:
+            self.stats.requests += 1
+            self.stats.by_status[status] = self.stats.by_status.get(status, 0) + 1
+            if status != 200:
+                self.stats.errors += 1
+            if streamed:
+                self.stats.streamed += 1
+
+    @staticmethod
+    def _build_content(payload: dict, name: str, answer: str, question: str) -> str:
+        prompt = "\n".join(m.get("content", "") for m in payload.get("messages", []))
+        if INTERVIEWER_MARKER in prompt:
+            return question
+        if "JSON-профиль" in prompt:
+            profile = {
+                "name": name,
+                "age": 35,
+                "profession": "бухгалтер",
+                "pain_points": ["Ручной ввод данных", "Сверка отчетов", "Нет интеграций"],
+                "communication_style": "Отвечает уклончиво, часто переспрашивает и уходит в истории.",
+                "traps": ["Ссылается на опыт 90-х", "Задает встречные вопросы", "Уходит в детали"],
+            }
+            return "```json\n" + json.dumps(profile, ensure_ascii=False) + "\n```"
+        return answer
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        delay, status, name, answer, question = self._draw()
+        await asyncio.sleep(delay)
+
+        if status != 200:
+            self._record(status)
+            return web.json_response({"error": {"code": status, "message": "injected error"}}, status=status)
+
+        content = self._build_content(payload, name, answer, question)
+        prompt_tokens = sum(len(m.get("content", "")) for m in payload.get("messages", [])) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        }
+        model = payload.get("model", "fake/model")
+
+        if payload.get("stream"):
+            self._record(status, streamed=True)
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for i in range(0, len(content), 16):
+                chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": content[i:i + 16]}}]}
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(self.stream_chunk_delay)
+            final = {"model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            await response.write(f"data: {json.dumps(final)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+
+        self._record(status)
+        return web.json_response({
+            "id": f"fake-{int(time.time() * 1000)}",
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    server = FakeOpenRouter(latency=LatencyModel("lognormal", 0.3, 0.4), port=8765)
+    server.start()
+    print(f"OPENROUTER_API_URL={server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,107 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Optional, Tuple
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {
+    "id": 100000,
+    "is_bot": True,
+    "first_name": "Custos Bench",
+    "username": "custos_bench_bot",
+}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Транспорт python-telegram-bot, отвечающий на вызовы Bot API локально.
+
+    Вместо HTTP-запросов к api.telegram.org формирует правдоподобные ответы
+    (sendMessage, editMessageText, answerCallbackQuery, getMe) с настраиваемой задержкой.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return 5.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._result_for(endpoint, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _result_for(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        return True
+
+
+class UpdateFactory:
+    """Генератор синтетических апдейтов Telegram от имени пользователей"""
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "language_code": "ru"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def text(self, user_id: int, text: str) -> Update:
+        data = {"update_id": next(self._update_ids), "message": self._message(user_id, text)}
+        return Update.de_json(data, self.bot)
+
+    def command(self, user_id: int, command: str) -> Update:
+        message = self._message(user_id, command)
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}]
+        return Update.de_json({"update_id": next(self._update_ids), "message": message}, self.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        bot_message = self._message(user_id, "Выберите действие:")
+        bot_message["from"] = BOT_USER
+        query = {
+            "id": str(next(self._update_ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": bot_message,
+        }
+        return Update.de_json({"update_id": next(self._update_ids), "callback_query": query}, self.bot)
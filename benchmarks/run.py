@@ -0,0 +1,337 @@
+"""Нагрузочный бенчмарк обработчиков Bot_Core/main.py.
+
+Запускает настоящие обработчики бота против локального fake OpenRouter и
+синтетических апдейтов Telegram, без доступа в сеть:
+
+    python -m benchmarks.run --scenario 200_concurrent_interviews
+    python -m benchmarks.run --list
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_openrouter import FakeOpenRouter, LatencyModel
+from benchmarks.fake_telegram import FakeTelegramRequest, UpdateFactory
+
+logger = logging.getLogger(__name__)
+
+BENCH_TOKEN = "123456:BENCHMARK-FAKE-TOKEN"
+
+QUESTIONS = [
+    "Как вы ведете финансовый учет?",
+    "Какие ошибки возникают чаще всего?",
+    "Сколько времени уходит на ручной ввод данных?",
+    "Пробовали ли вы автоматизировать отчетность?",
+    "Что мешает перейти на новый сервис?",
+]
+
+
+@dataclass
+class Scenario:
+    name: str
+    users: int = 10
+    questions: int = 3
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    error_rate: float = 0.0
+    telegram_latency: float = 0.0
+    description: str = ""
+
+
+SCENARIOS = {
+    "smoke": Scenario(
+        "smoke", users=5, questions=2, latency=LatencyModel("constant", 0.02),
+        description="Быстрая проверка, что стенд работает",
+    ),
+    "200_concurrent_interviews": Scenario(
+        "200_concurrent_interviews", users=200, questions=5, latency=LatencyModel("lognormal", 0.1, 0.5),
+        description="200 пользователей одновременно создают респондента и задают по 5 вопросов",
+    ),
+    "flaky_api": Scenario(
+        "flaky_api", users=50, questions=5, latency=LatencyModel("uniform", 0.1, 0.05), error_rate=0.2,
+        description="20% запросов к модели завершаются 429/5xx",
+    ),
+    "slow_telegram": Scenario(
+        "slow_telegram", users=50, questions=3, latency=LatencyModel("constant", 0.05), telegram_latency=0.2,
+        description="Задержка 200 мс на каждый вызов Bot API",
+    ),
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..100) методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+class LoopLagMonitor:
+    """Измеряет задержку event loop: насколько позже запланированного просыпается sleep()"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+        self._sleeping_since = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._sleeping_since = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - self._sleeping_since - self.interval))
+            self._sleeping_since = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+        await asyncio.sleep(0)
+
+    async def stop(self):
+        # Если цикл был заблокирован до самого конца, недоспанный интервал — тоже задержка
+        if self._sleeping_since is not None:
+            lag = asyncio.get_running_loop().time() - self._sleeping_since - self.interval
+            self.samples.append(max(0.0, lag))
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def import_bot(workdir: str, api_url: str):
+    """Импорт Bot_Core.main в изолированной рабочей директории (своя sessions.db и лог)"""
+    os.environ["TELEGRAM_BOT_TOKEN"] = BENCH_TOKEN
+    os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+    os.environ["OPENROUTER_API_URL"] = api_url
+    if "Bot_Core.main" in sys.modules:
+        return sys.modules["Bot_Core.main"]
+    # Консольный вывод глушим, запись в файл оставляем — она часть реальной нагрузки
+    os.environ.setdefault("LOG_CONSOLE_LEVEL", "CRITICAL")
+    os.chdir(workdir)
+    return importlib.import_module("Bot_Core.main")
+
+
+# save_state — запись SQLitePersistence (user_data и состояния диалога)
+DB_WRITE_METHODS = ("create_respondent", "create_interview", "add_response", "save_state")
+
+
+def instrument_db(db, samples: Dict[str, List[float]]):
+    """Оборачивает пишущие методы DatabaseManager замером времени"""
+    for name in DB_WRITE_METHODS:
+        original = getattr(type(db), name).__get__(db)
+
+        def timed(*args, _original=original, _name=name, **kwargs):
+            started = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                samples[_name].append(time.perf_counter() - started)
+
+        setattr(db, name, timed)
+
+
+def track_processed(application) -> Dict[int, asyncio.Future]:
+    """Future для каждого апдейта, разрешаемый после его обработки приложением.
+
+    Апдейты идут через application.update_queue, как при run_polling: приложение само
+    решает, обрабатывать ли их параллельно (concurrent_updates), поэтому бенчмарк
+    видит ту же очередь, что и пользователи в продакшене.
+    """
+    pending: Dict[int, asyncio.Future] = {}
+    original = application.process_update
+
+    async def process_update(update):
+        try:
+            await original(update)
+        finally:
+            future = pending.pop(update.update_id, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    application.process_update = process_update
+    return pending
+
+
+async def run_user(application, pending: Dict[int, asyncio.Future], factory: UpdateFactory,
+                   user_id: int, questions: int, latencies: Dict[str, List[float]]):
+    """Полный сценарий одного пользователя: /start → респондент → вопросы.
+
+    Задержка шага считается от постановки апдейта в очередь до конца обработки,
+    т. е. включает ожидание своей очереди.
+    """
+    script = [
+        ("start", factory.command(user_id, "/start")),
+        ("button_new_responder", factory.callback(user_id, "new_responder")),
+        ("button_trait", factory.callback(user_id, "trait_skeptic")),
+        ("profession", factory.text(user_id, "бухгалтер")),
+        ("age", factory.text(user_id, "35")),
+    ]
+    script += [("interview_question", factory.text(user_id, QUESTIONS[i % len(QUESTIONS)]))
+               for i in range(questions)]
+    for step, update in script:
+        done = asyncio.get_running_loop().create_future()
+        pending[update.update_id] = done
+        started = time.perf_counter()
+        await application.update_queue.put(update)
+        await done
+        latencies[step].append(time.perf_counter() - started)
+
+
+async def run_scenario(scenario: Scenario, workdir: str) -> dict:
+    server = FakeOpenRouter(latency=scenario.latency, error_rate=scenario.error_rate)
+    server.start()
+    bot_main = None
+    try:
+        bot_main = import_bot(workdir, server.url)
+        db_samples: Dict[str, List[float]] = defaultdict(list)
+        instrument_db(bot_main.db, db_samples)
+
+        telegram = FakeTelegramRequest(latency=scenario.telegram_latency)
+        from Bot_Core.data.persistence import SQLitePersistence
+        application = bot_main.build_application(
+            BENCH_TOKEN, request=telegram, persistence=SQLitePersistence(bot_main.db)
+        )
+        pending = track_processed(application)
+        await application.initialize()
+        await application.start()
+
+        factory = UpdateFactory(application.bot)
+        latencies: Dict[str, List[float]] = defaultdict(list)
+        monitor = LoopLagMonitor()
+        await monitor.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(application, pending, factory, 1000 + i, scenario.questions, latencies)
+            for i in range(scenario.users)
+        ))
+        # Ответы отправляются в фоне — ждем, пока очередь отправки опустеет
+        await bot_main.outbox.drain()
+        elapsed = time.perf_counter() - started
+        await monitor.stop()
+        # stop() сбрасывает накопленные данные в persistence — эти записи тоже попадают в db_write
+        await application.stop()
+        await application.shutdown()
+    finally:
+        server.stop()
+        if bot_main is not None:
+            for name in DB_WRITE_METHODS:
+                bot_main.db.__dict__.pop(name, None)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    all_db = [value for values in db_samples.values() for value in values]
+    return {
+        "scenario": scenario.name,
+        "config": {
+            "users": scenario.users,
+            "questions": scenario.questions,
+            "latency": asdict(scenario.latency),
+            "error_rate": scenario.error_rate,
+            "telegram_latency": scenario.telegram_latency,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "throughput": {
+            "updates_per_s": round(len(all_latencies) / elapsed, 2),
+            "interviews_per_s": round(scenario.users / elapsed, 3),
+            "llm_requests_per_s": round(server.stats.requests / elapsed, 2),
+        },
+        "handler_latency": {"all": summarize(all_latencies),
+                            **{step: summarize(values) for step, values in latencies.items()}},
+        "event_loop_lag": summarize(monitor.samples),
+        "db_write": {"all": summarize(all_db),
+                     **{name: summarize(values) for name, values in db_samples.items()}},
+        "llm": asdict(server.stats),
+        "telegram_calls": dict(telegram.calls),
+    }
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f"=== {result['scenario']} ===",
+        f"Конфигурация: {json.dumps(result['config'], ensure_ascii=False)}",
+        f"Время: {result['elapsed_s']} c",
+        "Пропускная способность: " + ", ".join(f"{k}={v}" for k, v in result["throughput"].items()),
+        "",
+        f"{'метрика':<28}{'count':>8}{'p50, мс':>12}{'p95, мс':>12}{'p99, мс':>12}{'max, мс':>12}",
+    ]
+    rows = [(f"handler:{k}", v) for k, v in result["handler_latency"].items()]
+    rows.append(("event_loop_lag", result["event_loop_lag"]))
+    rows += [(f"db:{k}", v) for k, v in result["db_write"].items()]
+    for name, s in rows:
+        lines.append(f"{name:<28}{s['count']:>8}{s['p50_ms']:>12}{s['p95_ms']:>12}{s['p99_ms']:>12}{s['max_ms']:>12}")
+    lines.append("")
+    lines.append(f"LLM: {json.dumps(result['llm'])}")
+    lines.append(f"Telegram: {json.dumps(result['telegram_calls'])}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк Custos AI Bot")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Сценарий (можно указать несколько раз), по умолчанию smoke")
+    parser.add_argument("--list", action="store_true", help="Показать доступные сценарии")
+    parser.add_argument("--users", type=int, help="Переопределить число пользователей")
+    parser.add_argument("--questions", type=int, help="Переопределить число вопросов на интервью")
+    parser.add_argument("--latency", type=float, help="Переопределить медианную задержку модели, с")
+    parser.add_argument("--error-rate", type=float, help="Переопределить долю ошибок API")
+    parser.add_argument("--json", dest="json_path", help="Сохранить результаты в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print(f"{name:<28}{scenario.description}")
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="custos-bench-") as workdir:
+        cwd = os.getcwd()
+        try:
+            for name in args.scenario or ["smoke"]:
+                scenario = SCENARIOS[name]
+                if args.users is not None:
+                    scenario.users = args.users
+                if args.questions is not None:
+                    scenario.questions = args.questions
+                if args.latency is not None:
+                    scenario.latency.mean = args.latency
+                if args.error_rate is not None:
+                    scenario.error_rate = args.error_rate
+                result = asyncio.run(run_scenario(scenario, workdir))
+                results.append(result)
+                print(format_report(result))
+                print()
+        finally:
+            os.chdir(cwd)
+            logging.shutdown()
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
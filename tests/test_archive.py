@@ -0,0 +1,83 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+from Bot_Core.data.archive import InterviewArchiver
+from Bot_Core.data.database import DatabaseManager, Interview
+
+
+def test_archived_interview_reads_back_from_segment(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'sessions.db'))
+    profile = {'name': 'Иван Петров', 'pain_points': ['Много ручной работы']}
+    respondent = db.create_respondent(name='Иван Петров', age=35, profession='бухгалтер',
+                                      trait='skeptic', profile=profile)
+    interview_id = db.create_interview(respondent_id=respondent.id, hypothesis='Ручной ввод отнимает время').id
+    turn = {'question': 'Как вы ведете учет?', 'answer': 'В Excel, вручную', 'cached': False}
+    db.add_response(interview_id, turn)
+    old = datetime.utcnow() - timedelta(days=120)
+    db.session.query(Interview).filter_by(id=interview_id).update({'created_at': old, 'updated_at': old})
+    db.session.commit()
+
+    archiver = InterviewArchiver(db.engine, archive_dir=str(tmp_path / 'archive'), retention_days=90)
+    stats = archiver.run()
+
+    assert stats['interviews'] == 1
+    db.session.expire_all()
+    assert db.get_interview(interview_id) is None
+
+    entries = archiver.search(profession='бухгалтер')
+    assert [(e['record_type'], e['record_id']) for e in entries] == [('interview', interview_id)]
+    records = list(archiver.load(entries))
+    assert len(records) == 1
+    record = records[0]
+    assert record['hypothesis'] == 'Ручной ввод отнимает время'
+    assert record['responses'][0]['text'] == turn
+    assert record['respondent']['profile'] == profile
+    assert record['created_at'] == old.isoformat()
+
+    # Сегмент — обычный gzip JSONL с заголовком формата
+    with gzip.open(os.path.join(archiver.archive_dir, entries[0]['segment']), 'rt', encoding='utf-8') as stream:
+        lines = [json.loads(line) for line in stream]
+    assert lines[0]['type'] == 'header'
+    assert lines[1:] == records
+
+
+def _old_interview(db, respondent_id: int, hypothesis: str, days: int = 120) -> int:
+    interview_id = db.create_interview(respondent_id=respondent_id, hypothesis=hypothesis).id
+    old = datetime.utcnow() - timedelta(days=days)
+    db.session.query(Interview).filter_by(id=interview_id).update({'created_at': old, 'updated_at': old})
+    db.session.commit()
+    return interview_id
+
+
+def test_archived_ids_are_not_reused(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'sessions.db'))
+    archiver = InterviewArchiver(db.engine, archive_dir=str(tmp_path / 'archive'), retention_days=90)
+    respondent_id = db.create_respondent(name='Анна', age=30, profession='бухгалтер', trait='chatty', profile={}).id
+    first_id = _old_interview(db, respondent_id, 'Первая гипотеза')
+    archiver.run()
+
+    second_id = _old_interview(db, respondent_id, 'Вторая гипотеза')
+    assert second_id != first_id
+    archiver.run()
+
+    entries = archiver.search(limit=None)
+    assert {(e['record_id'], e['hypothesis']) for e in entries} == {
+        (first_id, 'Первая гипотеза'), (second_id, 'Вторая гипотеза')
+    }
+    records = {r['id']: r for r in archiver.load(entries)}
+    assert records[first_id]['hypothesis'] == 'Первая гипотеза'
+    assert records[second_id]['hypothesis'] == 'Вторая гипотеза'
+
+
+def test_interview_with_recent_answers_is_not_archived(tmp_path):
+    db = DatabaseManager(str(tmp_path / 'sessions.db'))
+    archiver = InterviewArchiver(db.engine, archive_dir=str(tmp_path / 'archive'), retention_days=90)
+    respondent_id = db.create_respondent(name='Анна', age=30, profession='бухгалтер', trait='chatty', profile={}).id
+    interview_id = _old_interview(db, respondent_id, 'Долгое интервью')
+    db.add_response(interview_id, {'question': 'Еще вопрос?', 'answer': 'Еще ответ', 'cached': False})
+
+    assert archiver.run()['interviews'] == 0
+    db.session.expire_all()
+    assert len(db.get_interview(interview_id).responses) == 1
@@ -0,0 +1,46 @@
+import pytest
+
+from Bot_Core.analytics import russian_text
+from Bot_Core.analytics.russian_text import CandidateExtractor, snowball_stem
+
+
+@pytest.mark.parametrize('forms, stem', [
+    (('ручного', 'ручной', 'ручная'), 'ручн'),
+    (('ввода', 'ввод', 'вводом'), 'ввод'),
+    (('бухгалтеры', 'бухгалтеров', 'бухгалтер'), 'бухгалтер'),
+    (('отчетности', 'отчётность'), 'отчетн'),
+    (('тратят', 'тратил'), 'трат'),
+])
+def test_snowball_stem_merges_word_forms(forms, stem):
+    assert {snowball_stem(form) for form in forms} == {stem}
+
+
+def test_snowball_stem_keeps_short_words():
+    assert snowball_stem('в') == 'в'
+    assert snowball_stem('НДС') == 'ндс'
+
+
+@pytest.fixture
+def snowball_lemmas(monkeypatch):
+    # Ключ фразы без pymorphy, даже если он установлен
+    monkeypatch.setattr(russian_text, 'lemma', snowball_stem)
+    russian_text.phrase_key.cache_clear()
+    yield
+    russian_text.phrase_key.cache_clear()
+
+
+def test_phrase_key_ignores_word_forms(snowball_lemmas):
+    assert russian_text.phrase_key('ручного ввода') == ('ручн', 'ввод')
+    assert russian_text.phrase_key('Ручной ввод') == ('ручн', 'ввод')
+
+
+def test_keyword_matches_any_form(snowball_lemmas):
+    assert russian_text.keyword_matches('ручной ввод', 'много ручного ввода')
+    assert not russian_text.keyword_matches('ручной ввод', 'автоматический ввод')
+
+
+def test_candidates_stop_at_stop_words_and_punctuation():
+    candidates = CandidateExtractor()("Ну, я трачу много времени на ручной ввод данных.")
+    assert 'ручной ввод' in candidates
+    assert 'ввод данных' in candidates
+    assert not any('ну' in c.split() or 'на' in c.split() for c in candidates)